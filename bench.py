@@ -0,0 +1,311 @@
+"""
+Benchmarks for the simulation hot paths
+
+python3 bench.py                       print the runner scaling table
+python3 bench.py --suite -o out.json   run the suite and save the results
+python3 bench.py --suite --baseline base.json
+                                       also compare against saved results and
+                                       exit with 1 if anything regressed
+python3 bench.py --world               compare sleeping, broadphase and floor
+                                       tiling options for many runners
+
+Rendering is measured in an off-screen (headless) pyglet context when the
+platform provides one and is skipped otherwise.
+"""
+
+import argparse
+import json
+import math
+import platform
+import sys
+import time
+import timeit
+import world
+
+def drive(characters, tick):
+    """
+    Simple alternating gait so runners keep moving and touching the floor
+    """
+    phase = (tick // 20) % 2
+    for character in characters:
+        world.apply_controls(character, phase == 0, phase == 1, False, False)
+
+def bench_runners(counts=(1, 2, 4, 8, 16, 32, 64, 128, 256), ticks=100):
+    """
+    Compares runners sharing one space against one space per runner.
+    Returns a list of (count, shared steps/sec per runner, separate steps/sec per runner)
+    where a step is one call to world.step.
+    """
+    results = []
+    for count in counts:
+        space, characters = world.setup_runners(count)
+        start = time.perf_counter()
+        for tick in range(ticks):
+            drive(characters, tick)
+            world.step(space)
+        shared = count * ticks / (time.perf_counter() - start)
+
+        worlds = [world.setup_world() for i in range(count)]
+        start = time.perf_counter()
+        for tick in range(ticks):
+            for space, character in worlds:
+                drive([character], tick)
+                world.step(space)
+        separate = count * ticks / (time.perf_counter() - start)
+
+        results.append((count, shared, separate))
+    return results
+
+def print_runners(results):
+    print("%8s %16s %16s" % ("runners", "shared step/s", "separate step/s"))
+    for count, shared, separate in results:
+        print("%8d %16.1f %16.1f" % (count, shared, separate))
+
+# name: world-builder options for setup_runners, compared by bench_world
+WORLDS = {
+    "tree": {},
+    "tree+sleep": {"sleep": 0.5},
+    "hash": {"broadphase": "hash"},
+    "hash+tiles": {"broadphase": "hash", "tile": world.RUNNER_SPACING},
+    "large_world": world.large_world(),
+}
+
+def bench_world(counts=(1, 16, 64, 128, 256), spacings=(100, 500, world.RUNNER_SPACING), ticks=200, active=100):
+    """
+    Compares the world-builder options in WORLDS. Runners follow the gait for
+    the first active ticks and are then left alone, so most fall and come to
+    rest like the runners of a population search.
+    Returns a list of (count, spacing, {name: steps/sec per runner}, {name: runners asleep at the end})
+    """
+    results = []
+    for spacing in spacings:
+        for count in counts:
+            rates = {}
+            asleep = {}
+            for name, options in WORLDS.items():
+                space, characters = world.setup_runners(count, spacing=spacing, **options)
+                start = time.perf_counter()
+                for tick in range(ticks):
+                    if tick < active:
+                        drive(characters, tick)
+                    world.step(space)
+                rates[name] = count * ticks / (time.perf_counter() - start)
+                asleep[name] = sum(c.torso.is_sleeping for c in characters)
+            results.append((count, spacing, rates, asleep))
+    return results
+
+def print_world(results):
+    names = list(WORLDS)
+    print("%8s %8s" % ("runners", "spacing") + "".join("%18s" % name for name in names) + "  best")
+    for count, spacing, rates, asleep in results:
+        best = max(rates, key=rates.get)
+        print("%8d %8d" % (count, spacing) + "".join("%13.1f %3d%%" % (rates[n], 100*asleep[n]//count) for n in names) + "  " + best)
+    print("steps/sec per runner and the share of runners asleep at the end")
+
+def measure(fn, number=100, repeat=5):
+    """
+    Returns the best time in seconds for one call of fn
+    """
+    return min(timeit.repeat(fn, number=number, repeat=repeat)) / number
+
+def ticks_per_sec(count, ticks=200, substeps=world.SUBSTEPS):
+    space, characters = world.setup_runners(count, substeps=substeps)
+    start = time.perf_counter()
+    for tick in range(ticks):
+        drive(characters, tick)
+        world.step(space)
+    return count * ticks / (time.perf_counter() - start)
+
+def bench_suite(render=True):
+    """
+    Returns {name: {"value": float, "unit": str}}. Units ending in "/s" are
+    better when higher, units in seconds are better when lower.
+    """
+    results = {}
+    def record(name, value, unit):
+        results[name] = {"value": value, "unit": unit}
+
+    record("step_1_runner", ticks_per_sec(1), "ticks/s")
+    record("step_64_runners", ticks_per_sec(64, 50), "runner ticks/s")
+    record("step_1_runner_adaptive", ticks_per_sec(1, substeps=world.AdaptiveSubsteps()), "ticks/s")
+
+    space = world.setup_space()
+    record("construct", measure(lambda: world.add_runner(space), 20), "s")
+
+    space, character = world.setup_world()
+    for tick in range(100):
+        drive([character], tick)
+        world.step(space)
+    state = character.snapshot()
+    pose = [-math.pi/6, -math.pi/10, 0, math.pi/6, -math.pi/10, 0]
+    bodyx = world.WIDTH // 2
+    bodyy = character.torso.start_position[1] - 200*3/8
+    record("reset", measure(character.reset, 1000), "s")
+    record("set_pose", measure(lambda: character.set_pose(pose, bodyx, bodyy, 100, 200), 1000), "s")
+    record("snapshot", measure(character.snapshot, 1000), "s")
+    record("restore", measure(lambda: character.restore(state), 1000), "s")
+    record("observe", measure(character.observe, 1000), "s")
+
+    if render:
+        results.update(bench_render())
+    return results
+
+def bench_render(frames=100, runners=(1, 16)):
+    """
+    Frame times drawn into a hidden headless window: the ragdoll sprites
+    and the physics debug draw, the whole frame of qwop.py in its normal
+    and debug views, and the scenes of the demos in examples/ at their
+    default sizes. Returns {} when no GL context is available.
+    """
+    import pyglet
+    pyglet.options["headless"] = True
+    try:
+        window = pyglet.window.Window(640, 480, visible=False)
+    except Exception as e:
+        print("skipping render benchmarks:", e, file=sys.stderr)
+        return {}
+    import pymunk.pyglet_util
+    from pyglet import shapes
+    from pyglet.math import Mat4
+    from render import CharacterSprites, SpaceRenderer
+    import scenery
+    import scenes
+
+    results = {}
+    def frame_time(draw):
+        draw()
+        pyglet.gl.glFinish()
+        start = time.perf_counter()
+        for i in range(frames):
+            window.clear()
+            draw()
+        pyglet.gl.glFinish()
+        return (time.perf_counter() - start) / frames
+
+    for count in runners:
+        space, characters = world.setup_runners(count, spacing=0)
+        batch = pyglet.graphics.Batch()
+        sprites = [CharacterSprites(character, batch) for character in characters]
+        def draw():
+            for s in sprites:
+                s.update()
+            batch.draw()
+        results["frame_sprites_%d" % count] = {"value": frame_time(draw), "unit": "s"}
+
+        options = pymunk.pyglet_util.DrawOptions()
+        results["frame_debug_draw_%d" % count] = {"value": frame_time(lambda: space.debug_draw(options)), "unit": "s"}
+
+    # qwop.py's on_draw: screen-space bands, the scrolling start marker,
+    # the runner and the distance label
+    w, h = window.width, window.height
+    space, character = world.setup_world(w)
+    background_batch = pyglet.graphics.Batch()
+    track_batch = pyglet.graphics.Batch()
+    background = [shapes.Polygon((0, h*h1), (w, h*h1), (w, h*h2), (0, h*h2), color=c1 + c1 + c2 + c2,
+                                 batch=background_batch) for h1, h2, c1, c2 in scenery.bands(h)]
+    background += [shapes.Polygon(*quad, color=tuple(c for rgba in colors for c in rgba), batch=track_batch)
+                   for quad, colors in scenery.start_marker(w/2, h)]
+    label = pyglet.text.Label("", font_name="Times New Roman", font_size=24, x=w//2, y=h*0.9,
+                              anchor_x="center", anchor_y="center")
+    sprites = CharacterSprites(character)
+    joints = SpaceRenderer(space)
+    options = pymunk.pyglet_util.DrawOptions()
+    options.flags = options.DRAW_SHAPES | options.DRAW_COLLISION_POINTS
+    previous = character.snapshot()
+    frame = [0]
+    def game(debug):
+        def draw():
+            # scroll and relabel every frame as a moving runner does
+            frame[0] += 1
+            lc = character.torso.position.x + frame[0] % 100 - w//2
+            pyglet.gl.glEnable(pyglet.gl.GL_BLEND)
+            pyglet.gl.glBlendFunc(pyglet.gl.GL_SRC_ALPHA, pyglet.gl.GL_ONE_MINUS_SRC_ALPHA)
+            window.projection = Mat4.orthogonal_projection(0, w, 0, h, -1, 1)
+            background_batch.draw()
+            window.projection = Mat4.orthogonal_projection(lc, lc+w, 0, h, -1, 1)
+            track_batch.draw()
+            if debug:
+                space.debug_draw(options)
+                joints.draw()
+            else:
+                sprites.draw(previous, 0.5)
+            window.projection = Mat4.orthogonal_projection(0, w, 0, h, -1, 1)
+            label.text = "%.1f meters" % (frame[0] % 100 / 10)
+            label.draw()
+        return draw
+    results["frame_game"] = {"value": frame_time(game(False)), "unit": "s"}
+    results["frame_game_debug"] = {"value": frame_time(game(True)), "unit": "s"}
+    window.projection = Mat4.orthogonal_projection(0, w, 0, h, -1, 1)
+
+    # examples/: spiderweb.py draws through SpaceRenderer, the others
+    # through pymunk's debug draw
+    for name in scenes.SCENES:
+        scene = scenes.build(name)
+        if name == "web":
+            draw = SpaceRenderer(scene, point_size=4, pivot_size=6).draw
+        else:
+            scene_options = pymunk.pyglet_util.DrawOptions()
+            draw = lambda: scene.debug_draw(scene_options)
+        results["frame_scene_%s" % name] = {"value": frame_time(draw), "unit": "s"}
+
+    window.close()
+    return results
+
+def compare(results, baseline, tolerance=0.1):
+    """
+    Returns a list of (name, baseline, current, change) for every result that
+    is worse than baseline by more than tolerance (a fraction)
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        old = baseline[name]["value"]
+        new = result["value"]
+        if result["unit"].endswith("/s"):
+            change = (old - new) / old
+        else:
+            change = (new - old) / old
+        if change > tolerance:
+            regressions.append((name, old, new, change))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="QWOP benchmarks")
+    parser.add_argument("--suite", action="store_true", help="run the benchmark suite")
+    parser.add_argument("-o", "--output", help="write suite results to this JSON file")
+    parser.add_argument("--baseline", help="JSON file from an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed slowdown, as a fraction")
+    parser.add_argument("--no-render", action="store_true", help="skip rendering benchmarks")
+    parser.add_argument("--world", action="store_true", help="compare world-builder options for many runners")
+    args = parser.parse_args()
+
+    if args.world:
+        print_world(bench_world())
+        return 0
+    if not args.suite:
+        print_runners(bench_runners())
+        return 0
+
+    results = bench_suite(render=not args.no_render)
+    for name, result in results.items():
+        print("%-24s %14.6g %s" % (name, result["value"], result["unit"]))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"python": platform.python_version(),
+                       "machine": platform.machine(),
+                       "results": results}, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.tolerance)
+        for name, old, new, change in regressions:
+            print("REGRESSION %s: %.6g -> %.6g (%+.0f%%)" % (name, old, new, change*100))
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,151 @@
+"""
+Prefix-sharing cache of simulated world states
+
+Searches and replay analysis simulate many control sequences that start
+with the same moves. The cache stores world.snapshot states at every
+`interval` ticks in a trie keyed by the controls so far, so a new sequence
+resumes from its longest cached prefix instead of from tick zero.
+
+Results from the cache are approximate. Restoring a snapshot into a new
+world does not restore the solver's cached impulses or the contacts in
+progress (see character.save_bodies), and the small difference grows the
+way any difference does in a ragdoll that keeps falling over: a resumed
+run can end meters away from the full one. To keep the error from
+compounding, only runs simulated from tick zero store states, so every
+stored state is exact and a resumed run is one restore away from a full
+one. Treat cached distances as estimates for ranking candidates and use
+replay.run for results that must match replay.py.
+
+Runs are keyed by the world width and the runner's morphology, which
+includes its start pose, so different characters never share entries.
+"""
+
+import collections
+import numpy as np
+import morphology as morphology_spec
+import replay
+import world
+
+class Node:
+
+    def __init__(self, parent, chunk, tick):
+        self.parent = parent
+        self.chunk = chunk
+        self.tick = tick
+        self.children = {}
+        self.state = None
+
+class PrefixCache:
+
+    def __init__(self, interval=50, max_bytes=64*1024*1024):
+        """
+        interval: (int) ticks between stored states
+        max_bytes: (int) memory cap for stored states; least recently used
+                   states are evicted beyond it
+        """
+        self.interval = interval
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.roots = {}
+        self.lru = collections.OrderedDict()
+        self.lookups = 0
+        self.hits = 0
+        self.ticks_requested = 0
+        self.ticks_reused = 0
+        self.evictions = 0
+
+    def lookup(self, key, controls):
+        """
+        Returns (ticks, state) for the longest cached prefix of controls, or
+        (0, None). key identifies the start: character parameters and pose.
+        """
+        self.lookups += 1
+        self.ticks_requested += len(controls)
+        node = self.roots.get(key)
+        found = None
+        tick = 0
+        while node is not None:
+            if node.state is not None:
+                found = node
+            chunk = controls[tick:tick+self.interval].tobytes()
+            if len(chunk) < self.interval:
+                break
+            node = node.children.get(chunk)
+            tick += self.interval
+        if found is None or found.tick == 0:
+            return 0, None
+        self.hits += 1
+        self.ticks_reused += found.tick
+        self.lru.move_to_end(id(found))
+        return found.tick, found.state
+
+    def insert(self, key, controls, tick, state):
+        """
+        Stores state as the result of simulating controls[:tick] from key.
+        tick must be a multiple of interval.
+        """
+        node = self.roots.get(key)
+        if node is None:
+            node = self.roots[key] = Node(None, None, 0)
+        for start in range(0, tick, self.interval):
+            chunk = controls[start:start+self.interval].tobytes()
+            child = node.children.get(chunk)
+            if child is None:
+                child = node.children[chunk] = Node(node, chunk, start+self.interval)
+            node = child
+        if node.state is None:
+            node.state = state.copy()
+            self.bytes += node.state.nbytes
+            self.lru[id(node)] = node
+        self.lru.move_to_end(id(node))
+        while self.bytes > self.max_bytes and self.lru:
+            self.evict()
+
+    def evict(self):
+        """
+        Drops the least recently used state and prunes empty branches
+        """
+        i, node = self.lru.popitem(last=False)
+        self.bytes -= node.state.nbytes
+        node.state = None
+        self.evictions += 1
+        while node.parent is not None and node.state is None and not node.children:
+            del node.parent.children[node.chunk]
+            node = node.parent
+
+    def stats(self):
+        """
+        Returns a dict of hit rates and sizes for tuning interval and max_bytes
+        """
+        return {"lookups": self.lookups,
+                "hits": self.hits,
+                "hit_rate": self.hits / max(1, self.lookups),
+                "tick_reuse": self.ticks_reused / max(1, self.ticks_requested),
+                "states": len(self.lru),
+                "bytes": self.bytes,
+                "evictions": self.evictions}
+
+def run(cache, controls, width=world.WIDTH, morphology=None, stop_when_fallen=False):
+    """
+    Like replay.run for controls without resets, resuming from cache, or
+    filling it when nothing was cached. Returns (distance, ticks resumed
+    from the cache); the distance is approximate when ticks is nonzero.
+    morphology: (dict) the runner's body plan, see morphology.py
+    """
+    space, character = world.setup_world(width, morphology=morphology)
+    key = (width, morphology_spec.canonical(character.morphology))
+    controls = np.asarray(controls, np.uint8)
+    start, state = cache.lookup(key, controls)
+    if state is not None:
+        world.restore(space, state)
+
+    tick = start
+    for code in controls[start:].tolist():
+        replay.apply(character, code)
+        world.step(space)
+        tick += 1
+        if stop_when_fallen and world.fallen(character):
+            break
+        if start == 0 and tick % cache.interval == 0 and not world.fallen(character):
+            cache.insert(key, controls, tick, world.snapshot(space))
+    return world.distance(character), start
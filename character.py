@@ -1,80 +1,134 @@
 """
 alinen 2020
 Armless ragdoll character
+
+Physics only: this module does not import pyglet, so characters can be built
+and simulated without a window. See render.py for drawing.
 """
 
-import math
-import pyglet
-import pymunk, pymunk.pyglet_util
+import numpy as np
+import pymunk
+import pymunk.batch
 from pymunk.vec2d import Vec2d
+import morphology as morphology_spec
+
+# Every runner's shapes share this category and mask it out, so runners that
+# share a Space only collide with the floor and never with each other
+RUNNER_CATEGORY = 0b10
+RUNNER_MASK = pymunk.ShapeFilter.ALL_MASKS() ^ RUNNER_CATEGORY
+
+# Per body: x, y, angle, vx, vy, angular velocity
+BODY_STATE_SIZE = 6
+
+# Character.observation layout:
+#   [0, 42)  BODY_STATE_SIZE values for each of torso, thighL, thighR,
+#            calfL, calfR, footL, footR, in that order
+#   [42, 49) joint angles (second body angle minus first) for neck, hipL,
+#            hipR, kneeL, kneeR, ankleL, ankleR, in that order
+OBS_BODIES = ["torso", "thighL", "thighR", "calfL", "calfR", "footL", "footR"]
+OBS_JOINTS = 7
+OBS_SIZE = len(OBS_BODIES)*BODY_STATE_SIZE + OBS_JOINTS
+
+# Character.contacts has one row per body below with two columns: the
+# number of floor contacts the body has now, and the floor's normal impulse
+# on it accumulated over the last world.step (only in worlds built with
+# impulses=True, otherwise 0)
+CONTACT_BODIES = ["footL", "footR", "calfL", "calfR", "torso"]
+CONTACT_INDEX = {name: i for i, name in enumerate(CONTACT_BODIES)}
 
 class Character:
 
-    def __init__(self, space, bodyx, bodyy, w, h):
+    def __init__(self, space, bodyx, bodyy, w, h, group=1, observation=None, contacts=None, morphology=None):
+        """
+        group: (int) filter group for this runner's shapes; use a distinct
+               group per runner when several runners share a Space
+        observation: (array) OBS_SIZE floats to fill in observe(), such as a
+               row of a batch array shared by many runners; allocated if None
+        contacts: (array) shape (len(CONTACT_BODIES), 2) floor contact state
+               kept up to date by the world's collision handlers, see
+               CONTACT_BODIES; allocated if None
+        morphology: (dict) segments, masses, joints and start pose, see
+               morphology.py; morphology.DEFAULT if None
+        """
         self.space = space
-
-        mass = 20
-
-        torso = setup_body(space, bodyx+0, bodyy+h*3/8, mass*2, w, h*3/4, 1, 2)
-        head = setup_body(space, bodyx+0, bodyy+h*7/8, mass/2.0, w/2, h/4, 1, 2)
-
-        thighL = setup_body(space, bodyx-w/4.0, bodyy-h/4.0, mass, w/2.0, h/2.0, 2)
-        thighR = setup_body(space, bodyx+w/4.0, bodyy-h/4.0, mass, w/2.0, h/2.0, 2)
-
-        calfL = setup_body(space, bodyx-w/4.0, bodyy-h*3/4.0, mass, w/2.0, h/2.0, 2)
-        calfR = setup_body(space, bodyx+w/4.0, bodyy-h*3/4.0, mass, w/2.0, h/2.0, 2)
-
-        footL = setup_body(space, bodyx-w/4+w/8, bodyy-h*17/16, mass/2.0, w*3/4, h/8, 2)
-        footR = setup_body(space, bodyx+w/4+w/8, bodyy-h*17/16, mass/2.0, w*3/4, h/8, 2)
+        self.group = group
+        if observation is None:
+            observation = np.zeros(OBS_SIZE)
+        self.observation = observation
+        if contacts is None:
+            contacts = np.zeros((len(CONTACT_BODIES), 2))
+        self.contacts = contacts
+        self.morphology = morphology_spec.DEFAULT if morphology is None else morphology
+        template = morphology_spec.template(self.morphology, w, h)
+
+        shape_filter = pymunk.ShapeFilter(group=group, categories=RUNNER_CATEGORY, mask=RUNNER_MASK)
+        built = []
+        for name, center, mass, moment, size, collision_type, attributes in template.bodies:
+            body = setup_body(space, bodyx+center[0], bodyy+center[1], mass, size[0], size[1], collision_type,
+                              group, moment, template.friction, shape_filter)
+            # plain attributes go straight into the instance dict, skipping
+            # the __setattr__ pymunk objects route every assignment through
+            vars(body).update(attributes, character=self, contact_index=CONTACT_INDEX.get(name, -1))
+            setattr(self, name, body)
+            built.append(body)
 
         # Order determines draw order
-        self.bodies = [load_sprite("assets/hthigh.png", thighR), 
-                       load_sprite("assets/hcalf.png", calfR), 
-                       load_sprite("assets/hfoot.png", footR, (5, 0)), 
-                       load_sprite("assets/htorso.png", torso, (30, 10)), 
-                       load_sprite("assets/hthigh.png", thighL), 
-                       load_sprite("assets/hcalf.png", calfL), 
-                       load_sprite("assets/hfoot.png", footL, (5, 0)), 
-                       load_sprite("assets/hhead.png", head, (0,40))]
-
-        create_joint(space, torso,  head,   bodyx,       bodyy+h*3/4, -math.pi/10,  math.pi/10)
-        create_joint(space, torso,  thighL, bodyx-w/4,   bodyy      , -math.pi/10, math.pi/2)
-        create_joint(space, torso,  thighR, bodyx+w/4,   bodyy      , -math.pi/10, math.pi/2)
-        create_joint(space, thighL, calfL,  bodyx-w/4.0, bodyy-h/2.0, -math.pi/2,  -math.pi/3)
-        create_joint(space, thighR, calfR,  bodyx+w/4.0, bodyy-h/2.0, -math.pi/2,  -math.pi/3)
-        create_joint(space, calfL,  footL,  bodyx-w/4.0, bodyy-h    , -math.pi/10,  math.pi/10)
-        create_joint(space, calfR,  footR,  bodyx+w/4.0, bodyy-h    , -math.pi/10,  math.pi/10)
+        self.bodies = [built[i] for i in template.draw]
+
+        # Order determines the joint angle order in observations
+        self.joints = [create_joint(space, built[a], built[b], bodyx+pivot[0], bodyy+pivot[1], *limits)
+                       for a, b, pivot, limits in template.joints]
 
         # for debugging
         #torso_pin = pymunk.PinJoint(torso, space.static_body, (0,0), (bodyx, bodyy+h))
         #space.add(torso_pin)
 
-        # save variables as members
-        self.thighL = thighL
-        self.thighR = thighR
-        self.calfL = calfL
-        self.calfR = calfR
-        self.footL = footL
-        self.footR = footR
-        self.torso = torso
-
-        self.set_pose([-math.pi/6, -math.pi/10, 0, math.pi/6, -math.pi/10, 0], bodyx, bodyy, w, h)
-
-    def draw(self):
-        for graphic in self.bodies:
-            offset = rotate(graphic.body.angle, graphic.offset)
-            pos = graphic.body.position + offset # TODO DCJ
-            graphic.position = (pos.x, pos.y, 0)
-            graphic.rotation = -graphic.body.angle * 180 / math.pi
-            graphic.draw()
+        # tick of the world.step in which the head or torso first touched
+        # the floor, set by world.hit_ground; None while still up
+        self.fallen_tick = None
+        self.obs_bodies = [getattr(self, name) for name in OBS_BODIES]
+        self.observer = None
+
+        self.set_pose(template.pose, bodyx, bodyy, w, h)
 
     def get_position(self):
         return self.torso.position
 
     def reset(self):
-        for sprite in self.bodies:
-            sprite.body.position = sprite.body.start_position
-            sprite.body.angle = sprite.body.start_angle
+        self.fallen_tick = None
+        self.contacts[:, 1] = 0
+        for body in self.bodies:
+            body.position = body.start_position
+            body.angle = body.start_angle
+            body.velocity = 0, 0
+            body.angular_velocity = 0
+
+    def observe(self):
+        """
+        Refills self.observation in place and returns it. This exports
+        every body of the runner's space, so observe runners that share a
+        space together with world.observe.
+        """
+        if self.observer is None:
+            self.observer = Observer([self])
+        self.observer()
+        return self.observation
+
+    def snapshot(self, out=None):
+        """
+        Returns the dynamic state of every body as a flat array, see save_bodies
+        """
+        return save_bodies(self.bodies, out)
+
+    def restore(self, state, fallen_tick=None):
+        """
+        Puts back a state returned by snapshot without rebuilding the space
+        fallen_tick: (int) the runner's fallen_tick when state was taken;
+                     None for a state taken before it fell
+        """
+        load_bodies(self.bodies, state)
+        self.fallen_tick = fallen_tick
+        self.contacts[:, 1] = 0
 
     def move_thighL(self, force=9000):
         self.thighL.apply_impulse_at_local_point((force, 0), (0, 0))
@@ -89,57 +143,21 @@ class Character:
         self.calfR.apply_impulse_at_local_point((-force, 0), (0, 0))
 
     def set_pose(self, pose, bodyx, bodyy, w, h):
-        d11 = (bodyx-w/4, bodyy)
-        d21 = (bodyx+w/4, bodyy)
-
-        d2 = (0, -h/2)
-        d3 = (0, -h/2)
-        d4 = (w/4-w/8, -h*1/16)
-
-        p11 = d11
-        p12 = add(p11, rotate(pose[0], d2))
-        p13 = add(p12, rotate(pose[0]+pose[1], d3))
-        p14 = add(p13, rotate(pose[0]+pose[1]+pose[2], d4)) 
-
-        p21 = d21
-        p22 = add(p21, rotate(pose[3], d2))
-        p23 = add(p22, rotate(pose[3]+pose[4], d3))
-        p24 = add(p23, rotate(pose[3]+pose[4]+pose[5], d4)) 
-
-        self.thighL.start_position = mul(0.5, add(p12, p11))
-        self.thighL.start_angle = pose[0]
-
-        self.calfL.start_position = mul(0.5, add(p13, p12))
-        self.calfL.start_angle = pose[0]+pose[1]
-
-        self.footL.start_position = p14
-        self.footL.start_angle = pose[0]+pose[1]+pose[2]
-
-        self.thighR.start_position = mul(0.5, add(p22, p21))
-        self.thighR.start_angle = pose[3]
-
-        self.calfR.start_position = mul(0.5, add(p23, p22))
-        self.calfR.start_angle = pose[3]+pose[4]
-
-        self.footR.start_position = p24
-        self.footR.start_angle = pose[3]+pose[4]+pose[5]
-
+        """
+        Sets the start transform of every body and resets to it
+        pose: (list) start angles in the order of the morphology's "pose",
+              or a dict of them by body name
+        bodyx, bodyy, w, h: (float) as passed to the constructor
+        """
+        template = morphology_spec.template(self.morphology, w, h)
+        if isinstance(pose, dict):
+            pose = [pose.get(name, 0) for name in template.pose_names]
+        for name, (position, angle) in zip(template.names, template.start(pose, bodyx, bodyy)):
+            body = getattr(self, name)
+            body.start_position = Vec2d(*position)
+            body.start_angle = angle
         self.reset()
 
-def rotate(angle, p):
-    px = math.cos(angle) * p[0] - math.sin(angle) * p[1]
-    py = math.sin(angle) * p[0] + math.cos(angle) * p[1] 
-    return (px, py)
-
-def sub(a, b):
-    return (a[0]-b[0], a[1]-b[1])
-
-def add(a, b):
-    return (a[0]+b[0], a[1]+b[1])
-
-def mul(a, p):
-    return (a*p[0], a*p[1])
-
 def create_joint(space, b1, b2, px, py, lim1, lim2):
     """
     b1, b2: Body objects
@@ -152,33 +170,183 @@ def create_joint(space, b1, b2, px, py, lim1, lim2):
 
     b1_b2_limit = pymunk.RotaryLimitJoint(b1, b2, lim1, lim2)
     space.add(b1_b2_limit)
+    b1_b2.limit = b1_b2_limit
     return b1_b2
 
-def setup_body(space, centerx, centery, mass, width, height, collisionType, groupId = 1):
-    moment = pymunk.moment_for_box(mass, (width, height))
+def setup_body(space, centerx, centery, mass, width, height, collisionType, group = 1,
+               moment=None, friction=0.3, shape_filter=None):
+    """
+    moment: (float) moment of inertia, that of a width x height box if None
+    shape_filter: (ShapeFilter) shared filter, made from group if None
+    """
+    if moment is None:
+        moment = pymunk.moment_for_box(mass, (width, height))
     body = pymunk.Body(mass, moment)
     body.position = centerx, centery
-    body.start_position = Vec2d(*body.position)
-    body.start_angle = 0
-    body.width = width
-    body.height = height
-    
+    vars(body).update(start_position=Vec2d(*body.position), start_angle=0, width=width, height=height)
+
     shape = pymunk.Poly.create_box(body, (width, height))
-    shape.friction = 0.3
+    shape.friction = friction
     shape.collision_type = collisionType
-    shape.filter = pymunk.ShapeFilter(group=1)
-    shape.group = groupId
+    if shape_filter is None:
+        shape_filter = pymunk.ShapeFilter(group=group, categories=RUNNER_CATEGORY, mask=RUNNER_MASK)
+    shape.filter = shape_filter
     space.add(body, shape)
     return body
 
-# https://pyglet.readthedocs.io/en/latest/modules/sprite.html
-def load_sprite(name, body, offset=(0,0)):
-    image = pyglet.resource.image(name)                        
-    image.anchor_x = image.width // 2
-    image.anchor_y = image.height // 2
-    sprite = pyglet.sprite.Sprite(image)
-    #sprite.scale = body.height / (image.height)
-    sprite.body = body
-    sprite.offset = offset
-    return sprite
+# Fields of the bulk body export, one row per body
+_FIELDS = pymunk.batch.BodyFields.BODY_ID | pymunk.batch.BodyFields.POSITION | pymunk.batch.BodyFields.ANGLE
+# with velocities the rows have the save_bodies layout
+_STATE_FIELDS = _FIELDS | pymunk.batch.BodyFields.VELOCITY | pymunk.batch.BodyFields.ANGULAR_VELOCITY
+
+class Transforms:
+    """
+    Gathers the (x, y, angle) of every body of a fixed list of runners, in
+    Character.bodies order, the same transforms CharacterSprites draws
+
+    Reading bodies one attribute at a time costs a few microseconds each,
+    so instead every space the runners live in is exported in bulk into one
+    buffer and the rows are picked out with an index that is rebuilt only
+    when the exported bodies change. Bodies no longer in a space (see
+    world.retire) are read one by one.
+    """
+
+    def __init__(self, characters, velocities=False):
+        """
+        velocities: (bool) gather the BODY_STATE_SIZE values of
+                    save_bodies per body instead of 3
+        """
+        self.characters = characters
+        self.bodies = [body for character in characters for body in character.bodies]
+        self.fields = _STATE_FIELDS if velocities else _FIELDS
+        self.shape = (len(characters), len(characters[0].bodies), BODY_STATE_SIZE if velocities else 3)
+        self.buffer = pymunk.batch.Buffer()
+        self.spaces = list({body.space: None for body in self.bodies if body.space is not None})
+        self.ids = None
+
+    def index(self, ids):
+        """
+        Sets self.found, the rows of bodies present in the export,
+        self.rows, their export rows, and self.missing, the rest
+        ids: (bytes) body ids in export order
+        """
+        self.ids = ids
+        row = {body_id: i for i, body_id in enumerate(np.frombuffer(ids, dtype=np.uintp).tolist())}
+        found = [i for i, body in enumerate(self.bodies) if body.id in row]
+        self.found = np.array(found, dtype=np.intp)
+        self.rows = np.array([row[self.bodies[i].id] for i in found], dtype=np.intp)
+        self.missing = [i for i, body in enumerate(self.bodies) if body.id not in row]
+
+    def __call__(self, out=None):
+        """
+        Writes the transforms into out (allocated if None) and returns it,
+        shape (runners, bodies, 3 or BODY_STATE_SIZE)
+        """
+        if out is None:
+            out = np.empty(self.shape)
+        flat = out.reshape(-1, self.shape[2])
+        self.buffer.clear()
+        for space in self.spaces:
+            pymunk.batch.get_space_bodies(space, self.fields, self.buffer)
+        if self.ids != self.buffer.int_buf():
+            self.index(bytes(self.buffer.int_buf()))
+        flat[self.found] = np.frombuffer(self.buffer.float_buf()).reshape(-1, self.shape[2])[self.rows]
+        for i in self.missing:
+            self.read(flat, i)
+        return out
+
+    def read(self, flat, i):
+        body = self.bodies[i]
+        x, y = body.position
+        if self.shape[2] == 3:
+            flat[i] = x, y, body.angle
+        else:
+            save_bodies([body], flat[i])
+
+class Observer:
+    """
+    Fills the observations of a fixed list of runners from one Transforms
+    export instead of reading their bodies one attribute at a time. When
+    the runners' observation buffers are consecutive rows of one array, as
+    world.setup_runners and vecenv make them, they are written in place.
+    """
 
+    def __init__(self, characters):
+        self.characters = characters
+        self.gather = Transforms(characters, velocities=True)
+        self.state = np.empty(self.gather.shape)
+        # indices into the flattened state of each runner's observed values
+        # and of the angles of the two bodies of each joint
+        bodies = self.gather.shape[1]
+        def flat(i, body, field):
+            return (i*bodies + characters[i].bodies.index(body))*BODY_STATE_SIZE + field
+        self.obs_index = np.array([[flat(i, body, field) for body in c.obs_bodies for field in range(BODY_STATE_SIZE)]
+                                   for i, c in enumerate(characters)])
+        self.joint_a = np.array([[flat(i, joint.a, 2) for joint in c.joints] for i, c in enumerate(characters)])
+        self.joint_b = np.array([[flat(i, joint.b, 2) for joint in c.joints] for i, c in enumerate(characters)])
+        self.out = batch_rows([c.observation for c in characters])
+        self.scratch = None if self.out is not None else np.empty((len(characters), OBS_SIZE))
+
+    def __call__(self):
+        """
+        Refills every runner's observation and returns them, shape
+        (runners, OBS_SIZE); the returned array is reused by the next call
+        """
+        state = self.gather(self.state).reshape(-1)
+        out = self.scratch if self.out is None else self.out
+        size = len(OBS_BODIES)*BODY_STATE_SIZE
+        out[:, :size] = state.take(self.obs_index)
+        np.subtract(state.take(self.joint_b), state.take(self.joint_a), out=out[:, size:])
+        if self.out is None:
+            for character, row in zip(self.characters, out):
+                character.observation[:] = row
+        return out
+
+def batch_rows(arrays):
+    """
+    Returns the block of one 2D array whose consecutive rows are arrays,
+    or None if they are not laid out that way
+    """
+    base = arrays[0].base
+    if base is None or base.ndim != 2 or any(a.base is not base for a in arrays):
+        return None
+    # rows must be whole, contiguous rows of base, not slices of wider ones
+    if base.shape[1] != arrays[0].size or base.strides[1] != base.itemsize:
+        return None
+    stride = base.strides[0]
+    start, offset = divmod(arrays[0].ctypes.data - base.ctypes.data, stride)
+    if offset or any(a.ctypes.data != arrays[0].ctypes.data + i*stride for i, a in enumerate(arrays)):
+        return None
+    return base[start:start + len(arrays)]
+
+def save_bodies(bodies, out=None):
+    """
+    Writes BODY_STATE_SIZE floats per body into out (allocated if None) and
+    returns it. The joints in this project hold no state besides the bodies
+    they connect, so this is the complete dynamic state of a runner. pymunk
+    does not expose the solver's cached impulses, so a restored run agrees
+    with the original to solver tolerance rather than bit for bit.
+    """
+    if out is None:
+        out = np.empty(len(bodies)*BODY_STATE_SIZE)
+    i = 0
+    for body in bodies:
+        x, y = body.position
+        vx, vy = body.velocity
+        out[i:i+BODY_STATE_SIZE] = (x, y, body.angle, vx, vy, body.angular_velocity)
+        i += BODY_STATE_SIZE
+    return out
+
+def load_bodies(bodies, state):
+    """
+    Inverse of save_bodies
+    """
+    values = state.tolist()
+    i = 0
+    for body in bodies:
+        x, y, angle, vx, vy, w = values[i:i+BODY_STATE_SIZE]
+        body.position = x, y
+        body.angle = angle
+        body.velocity = vx, vy
+        body.angular_velocity = w
+        i += BODY_STATE_SIZE
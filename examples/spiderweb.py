@@ -7,91 +7,27 @@ It is possible to grab one of the crossings with the mouse
 __version__ = "$Id:$"
 __docformat__ = "reStructuredText"
 
-import math, random
+import os, sys
 import pyglet
 import pymunk
 from pymunk.vec2d import Vec2d
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import scenes
+from render import SpaceRenderer
+
 config = pyglet.gl.Config(sample_buffers=1, samples=2, double_buffer=True)
 window = pyglet.window.Window(config=config, vsync = False)
-space = pymunk.Space()
-
-space.gravity = 0,-900
-space.damping = .999
 c = Vec2d(window.width /2., window.height / 2.)        
-        
-### WEB
-web_group = 1
-bs = []
-dist = .3
-
-cb = pymunk.Body(1,1)
-cb.position = c
-s = pymunk.Circle(cb, 15) # to have something to grab
-s.filter = pymunk.ShapeFilter(group = web_group)
-s.ignore_draw = True
-space.add(cb, s)
-
-
-#generate each crossing in the net
-for x in range(0,101):
-    b = pymunk.Body(1, 1)
-    v = Vec2d.unit()
-    v.angle_degrees = x*18
-    scale = window.height / 2. / 6. * .5
-    
-    dist += 1/18. 
-    dist = dist ** 1.005
-    
-    offset = 0
-    offset = [0.0, -0.80, -1.0, -0.80][((x*18) % 360)//18 % 4]
-    offset = .8 + offset
-    
-    offset *= dist**2.8 / 100.
-    
-    #print "offset", offset
-    
-    v.length = scale * (dist + offset) 
-    
-    b.position = c + v
-    s = pymunk.Circle(b, 15)
-    s.filter = pymunk.ShapeFilter(group = web_group)
-    s.ignore_draw = True
-    space.add(b,s)
-    bs.append(b)
-    
-def add_joint(a,b):
-    rl = a.position.get_distance(b.position) * 0.9
-    stiffness = 5000.
-    damping = 100
-    j = pymunk.DampedSpring(a, b, (0,0), (0,0), rl, stiffness, damping)
-    j.max_bias = 1000
-    #j.max_force = 50000
-    space.add(j)
-    
-for b in bs[:20]:
-    add_joint(cb,b)
-    
-for i in range(len(bs)-1):
-    add_joint(bs[i], bs[i+1])
 
-    i2 = i+20
-    if len(bs) > i2:
-        add_joint(bs[i], bs[i2])   
+### WEB
+# python3 spiderweb.py RINGS draws the stress.py web scene at that size
+rings = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+space = scenes.web(rings, center=c, radius=window.height / 2.)
+bs = space.web
 
-        
 ### WEB ATTACH POINTS
-static_bs = []
-for b in bs[-17::4]:
-    static_body = pymunk.Body(body_type = pymunk.Body.STATIC)
-    static_body.position = b.position
-    static_bs.append(static_body)
-    
-    j = pymunk.PivotJoint(static_body, b, static_body.position)
-    j = pymunk.DampedSpring(static_body, b, (0,0), (0,0), 0, 0, 0)
-    j.damping = 100
-    j.stiffness = 20000
-    space.add(j)
+static_bs = space.attach_points
 
 ### ALL SETUP DONE 
     
@@ -141,38 +77,19 @@ def on_key_press(symbol, modifiers):
    
 fps_display = pyglet.window.FPSDisplay(window)
 
+# Vertex lists for the bodies, springs and attach points are allocated once
+# and rewritten in place each frame, one draw call per category
+web = SpaceRenderer(space, point_size=4, pivot_size=6,
+                    colors={"dynamic": (204, 204, 204, 255), "constraint": (0, 0, 0, 255)})
+
 @window.event
 def on_draw():
-    pyglet.gl.glClearColor(240,240,240,255)
+    pyglet.gl.glClearColor(240/255., 240/255., 240/255., 1)
     window.clear()
     
     fps_display.draw()
     
-    # static attach points
-    pyglet.gl.glColor3f(1,0,1)
-    pyglet.gl.glPointSize(6)
-    a = []
-    for b in static_bs:
-        a += [b.position.x, b.position.y]
-        pyglet.graphics.draw(len(a)//2, pyglet.gl.GL_POINTS, ('v2f',a))
-    
-    # web crossings / bodies
-    pyglet.gl.glColor3f(.8,.8,.8)
-    a = []
-    for b in bs:
-        a += [b.position.x, b.position.y]
-    pyglet.gl.glPointSize(4)
-    pyglet.graphics.draw(len(a)//2, pyglet.gl.GL_POINTS, ('v2f',a))
-    
-    
-    # web net / constraints
-    a = []
-    for j in space.constraints:
-        a += [j.a.position.x, j.a.position.y, j.b.position.x, j.b.position.y]
-        pass
-    
-    pyglet.graphics.draw(len(a)//2, pyglet.gl.GL_LINES, ('v2f',a))
-     
-    # anything else
+    # web crossings, static attach points and the springs between them
+    web.draw()
     
 pyglet.app.run()
\ No newline at end of file
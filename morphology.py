@@ -0,0 +1,335 @@
+"""
+Declarative runner morphologies and cached templates to build runners from
+
+python3 morphology.py --vary mass=15,20,25 --vary joints.thighL-calfL.limits.0=-1.8,-1.57
+                                    run every combination against 20 random
+                                    gaits on all cores and print distances
+python3 morphology.py --spec legs.json best.qwop    score a spec on recordings
+python3 morphology.py --dump        print DEFAULT as JSON, to edit into a spec
+
+A morphology is a plain dict, so variants can be saved as JSON or made from
+DEFAULT with vary(). Lengths and positions are fractions of the runner's
+width and height (w and h in world.add_runner), measured from (bodyx,
+bodyy), the hip height on the runner's center line. Masses are multiples
+of "mass". "pose" holds the start angle of bodies relative to the body
+they hang from; bodies not listed start at 0.
+
+Characters only read a spec through template(), which works out
+everything that does not depend on where a runner stands once per spec
+and size. Treat a spec as read-only after building runners from it.
+"""
+
+import argparse
+import collections
+import copy
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import sys
+import numpy as np
+import pymunk
+
+# Sprite image names are relative to the project, wherever the program is
+# run from
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT = {
+    "mass": 20,
+    "friction": 0.3,
+    # bodies are added to the space in this order; collision type 1 ends
+    # a run when it touches the floor
+    "bodies": [
+        {"name": "torso", "center": [0, 0.375], "size": [1, 0.75], "mass": 2,
+         "collision_type": 1, "sprite": "assets/htorso.png", "offset": [30, 10]},
+        {"name": "head", "center": [0, 0.875], "size": [0.5, 0.25], "mass": 0.5,
+         "collision_type": 1, "sprite": "assets/hhead.png", "offset": [0, 40]},
+        {"name": "thighL", "center": [-0.25, -0.25], "size": [0.5, 0.5], "mass": 1,
+         "collision_type": 2, "sprite": "assets/hthigh.png", "offset": [0, 0]},
+        {"name": "thighR", "center": [0.25, -0.25], "size": [0.5, 0.5], "mass": 1,
+         "collision_type": 2, "sprite": "assets/hthigh.png", "offset": [0, 0]},
+        {"name": "calfL", "center": [-0.25, -0.75], "size": [0.5, 0.5], "mass": 1,
+         "collision_type": 2, "sprite": "assets/hcalf.png", "offset": [0, 0]},
+        {"name": "calfR", "center": [0.25, -0.75], "size": [0.5, 0.5], "mass": 1,
+         "collision_type": 2, "sprite": "assets/hcalf.png", "offset": [0, 0]},
+        {"name": "footL", "center": [-0.125, -1.0625], "size": [0.75, 0.125], "mass": 0.5,
+         "collision_type": 2, "sprite": "assets/hfoot.png", "offset": [5, 0]},
+        {"name": "footR", "center": [0.375, -1.0625], "size": [0.75, 0.125], "mass": 0.5,
+         "collision_type": 2, "sprite": "assets/hfoot.png", "offset": [5, 0]},
+    ],
+    # Character.bodies order, which is the draw order
+    "draw": ["thighR", "calfR", "footR", "torso", "thighL", "calfL", "footL", "head"],
+    # order of the joint angles in observations; limits in radians
+    "joints": [
+        {"a": "torso", "b": "head", "pivot": [0, 0.75], "limits": [-math.pi/10, math.pi/10]},
+        {"a": "torso", "b": "thighL", "pivot": [-0.25, 0], "limits": [-math.pi/10, math.pi/2]},
+        {"a": "torso", "b": "thighR", "pivot": [0.25, 0], "limits": [-math.pi/10, math.pi/2]},
+        {"a": "thighL", "b": "calfL", "pivot": [-0.25, -0.5], "limits": [-math.pi/2, -math.pi/3]},
+        {"a": "thighR", "b": "calfR", "pivot": [0.25, -0.5], "limits": [-math.pi/2, -math.pi/3]},
+        {"a": "calfL", "b": "footL", "pivot": [-0.25, -1], "limits": [-math.pi/10, math.pi/10]},
+        {"a": "calfR", "b": "footR", "pivot": [0.25, -1], "limits": [-math.pi/10, math.pi/10]},
+    ],
+    "pose": {"thighL": -math.pi/6, "calfL": -math.pi/10, "footL": 0,
+             "thighR": math.pi/6, "calfR": -math.pi/10, "footR": 0},
+}
+
+# Bodies the game refers to by name: controls, observations, contacts and
+# the eight sprite layers of render.py
+REQUIRED = ["torso", "head", "thighL", "thighR", "calfL", "calfR", "footL", "footR"]
+JOINTS = 7 # character.OBS_JOINTS
+
+class Template:
+    """
+    A morphology worked out for one runner size. Positions are offsets from
+    (bodyx, bodyy); per-body attributes that every runner shares are ready
+    to be copied onto new bodies. Bodies are in spec order, and draw
+    indexes them in Character.bodies order.
+    """
+
+    def __init__(self, spec, w, h):
+        names = [part["name"] for part in spec["bodies"]]
+        if sorted(names) != sorted(REQUIRED):
+            raise ValueError("morphology bodies must be %s, each once" % ", ".join(REQUIRED))
+        if len(spec["joints"]) != JOINTS:
+            raise ValueError("morphology needs %d joints, has %d" % (JOINTS, len(spec["joints"])))
+        index = {name: i for i, name in enumerate(names)}
+        used = spec.get("draw", []) + list(spec["pose"]) + [joint[key] for joint in spec["joints"] for key in "ab"]
+        unknown = sorted(set(used) - set(index))
+        if unknown:
+            raise ValueError("morphology refers to unknown bodies %s" % ", ".join(unknown))
+        self.names = names
+        self.draw = [index[name] for name in spec.get("draw", names)]
+        mass = spec["mass"]
+        self.friction = spec["friction"]
+
+        # name, center, mass, moment, size, collision type, attributes
+        self.bodies = []
+        for part in spec["bodies"]:
+            size = (w*part["size"][0], h*part["size"][1])
+            body_mass = mass*part["mass"]
+            self.bodies.append((part["name"], (w*part["center"][0], h*part["center"][1]), body_mass,
+                                pymunk.moment_for_box(body_mass, size), size, part["collision_type"],
+                                {"width": size[0], "height": size[1], "sprite": part["sprite"],
+                                 "offset": tuple(part["offset"])}))
+
+        # a index, b index, pivot, limits
+        self.joints = [(index[joint["a"]], index[joint["b"]], (w*joint["pivot"][0], h*joint["pivot"][1]),
+                        tuple(joint["limits"])) for joint in spec["joints"]]
+
+        # bodies in the order set_pose places them: each body after the one
+        # it hangs from, as (body, parent joint, child joints)
+        children = {}
+        parent = {}
+        for j, (a, b, pivot, limits) in enumerate(self.joints):
+            children.setdefault(a, []).append(j)
+            parent[b] = j
+        roots = [i for i in range(len(names)) if i not in parent]
+        if len(roots) != 1:
+            raise ValueError("morphology joints must connect every body into one tree")
+        self.order = []
+        pending = list(roots)
+        while pending:
+            i = pending.pop(0)
+            self.order.append((i, parent.get(i), children.get(i, [])))
+            pending += [self.joints[j][1] for j in children.get(i, [])]
+        self.root = roots[0]
+        self.pose_names = list(spec["pose"])
+        self.pose = [spec["pose"][name] for name in self.pose_names]
+        self.pose_index = [index[name] for name in self.pose_names]
+
+    def midway(self, i, j, k):
+        """
+        True when body i rests exactly halfway between pivots j and k
+        """
+        center = self.bodies[i][1]
+        pj, pk = self.joints[j][2], self.joints[k][2]
+        return center == (0.5*(pj[0] + pk[0]), 0.5*(pj[1] + pk[1]))
+
+    def start(self, pose, bodyx, bodyy):
+        """
+        Returns the start (position, angle) of every body for pose
+        pose: (list) angles in the order of the spec's "pose"
+
+        Pivots are chained outward from the root in world coordinates, and
+        a body that rests halfway between its two pivots stays halfway, the
+        same arithmetic the hand-written ragdoll used, so DEFAULT starts
+        bit-identically and old replay.py recordings still reproduce.
+        """
+        relative = [0.0]*len(self.bodies)
+        for i, angle in zip(self.pose_index, pose):
+            relative[i] = angle
+        start = [None]*len(self.bodies)
+        angles = [0.0]*len(self.bodies)
+        pivots = {}
+        for i, j, child_joints in self.order:
+            center = self.bodies[i][1]
+            if j is None:
+                angle = relative[i]
+                p = (bodyx + center[0], bodyy + center[1])
+                rest = center
+            else:
+                angle = angles[self.joints[j][0]] + relative[i]
+                p = pivots[j]
+                rest = self.joints[j][2]
+            for k in child_joints:
+                pivot = self.joints[k][2]
+                pivots[k] = add(p, rotate(angle, (pivot[0] - rest[0], pivot[1] - rest[1])))
+            if j is not None and len(child_joints) == 1 and self.midway(i, j, child_joints[0]):
+                position = mul(0.5, add(pivots[child_joints[0]], p))
+            else:
+                position = add(p, rotate(angle, (center[0] - rest[0], center[1] - rest[1])))
+            start[i] = (position, angle)
+            angles[i] = angle
+        return start
+
+# spec as sorted JSON, w, h: Template, one per distinct spec and size
+_templates = {}
+# id(spec), w, h: (spec, Template) for the specs used last, which skips
+# serializing them again; the spec is kept so its id stays unique
+_recent = collections.OrderedDict()
+RECENT = 16
+
+def template(spec, w, h):
+    """
+    Returns the Template of spec at size (w, h), built once per distinct
+    spec and cached, so copies of a spec, such as ones unpickled in pool
+    workers or loaded from JSON again, share one
+    """
+    key = (id(spec), w, h)
+    entry = _recent.get(key)
+    if entry is None:
+        key_of_spec = (canonical(spec), w, h)
+        if key_of_spec not in _templates:
+            _templates[key_of_spec] = Template(spec, w, h)
+        entry = _recent[key] = (spec, _templates[key_of_spec])
+        if len(_recent) > RECENT:
+            _recent.popitem(last=False)
+    return entry[1]
+
+def canonical(spec):
+    """
+    Returns spec as a string that is equal for equal specs, to key caches by
+    """
+    return json.dumps(spec, sort_keys=True)
+
+def rotate(angle, p):
+    px = math.cos(angle) * p[0] - math.sin(angle) * p[1]
+    py = math.sin(angle) * p[0] + math.cos(angle) * p[1]
+    return (px, py)
+
+def add(a, b):
+    return (a[0]+b[0], a[1]+b[1])
+
+def mul(a, p):
+    return (a*p[0], a*p[1])
+
+def vary(spec, path, value):
+    """
+    Returns a copy of spec with the entry at path set to value
+    path: (str) keys separated by dots. In lists, numbers are indices,
+          other keys pick the body with that name or the joint "a-b",
+          e.g. "bodies.thighL.size.1" or "joints.thighL-calfL.limits.0"
+    """
+    spec = copy.deepcopy(spec)
+    keys = path.split(".")
+    container = spec
+    for key in keys[:-1]:
+        container = container[lookup(container, key)]
+    container[lookup(container, keys[-1])] = value
+    return spec
+
+def lookup(container, key):
+    if isinstance(container, dict):
+        if key not in container:
+            raise KeyError(key)
+        return key
+    if key.lstrip("-").isdigit():
+        return int(key)
+    for i, item in enumerate(container):
+        if item.get("name") == key or "%s-%s" % (item.get("a"), item.get("b")) == key:
+            return i
+    raise KeyError(key)
+
+def evaluate(args):
+    """
+    Returns the distance a runner of morphology spec covers with controls,
+    ending the run once it falls
+    """
+    spec, controls = args
+    import replay, world
+    space, character = world.setup_world(morphology=spec)
+    for code in controls.tolist():
+        replay.apply(character, code)
+        world.step(space)
+        if world.fallen(character):
+            break
+    return world.distance(character)
+
+def sweep(spec, variations, gaits, processes=None):
+    """
+    Scores every combination of variations against every gait across a
+    process pool. Returns one dict per combination with its values and the
+    mean and best distance over gaits.
+    variations: (list) (path, values) pairs, see vary
+    gaits: (list) control arrays, as replay.load returns
+    """
+    combos = list(itertools.product(*[values for path, values in variations]))
+    specs = []
+    for combo in combos:
+        variant = spec
+        for (path, values), value in zip(variations, combo):
+            variant = vary(variant, path, value)
+        specs.append(variant)
+    jobs = [(variant, controls) for variant in specs for controls in gaits]
+    with multiprocessing.Pool(processes) as pool:
+        distances = pool.map(evaluate, jobs, chunksize=max(1, len(jobs)//(4*(processes or multiprocessing.cpu_count()))))
+    distances = np.array(distances).reshape(len(specs), len(gaits))
+    return [{"values": dict(zip([path for path, values in variations], combo)),
+             "mean": float(row.mean()), "best": float(row.max())}
+            for combo, row in zip(combos, distances)]
+
+def main():
+    import optimize, replay
+    parser = argparse.ArgumentParser(description="Score morphology variants on all cores")
+    parser.add_argument("recordings", nargs="*", help="replay.py recordings to score with")
+    parser.add_argument("--spec", help="JSON morphology to start from, DEFAULT if not given")
+    parser.add_argument("--vary", action="append", default=[], metavar="PATH=V1,V2,...",
+                        help="values to try for one entry of the spec, see vary()")
+    parser.add_argument("--gaits", type=int, default=20, help="random gaits when no recordings are given")
+    parser.add_argument("--ticks", type=int, default=1000, help="ticks of each random gait")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--processes", type=int, help="worker processes, all cores if not given")
+    parser.add_argument("--dump", action="store_true", help="print the spec as JSON and exit")
+    parser.add_argument("-o", "--output", help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    spec = DEFAULT
+    if args.spec:
+        with open(args.spec) as f:
+            spec = json.load(f)
+    if args.dump:
+        print(json.dumps(spec, indent=2))
+        return 0
+    variations = []
+    for entry in args.vary:
+        path, values = entry.split("=", 1)
+        variations.append((path, [json.loads(value) for value in values.split(",")]))
+
+    if args.recordings:
+        gaits = [replay.load(path)[1] for path in args.recordings]
+    else:
+        rng = np.random.default_rng(args.seed)
+        gaits = [optimize.expand(rng.integers(replay.NONE, replay.P + 1, size=8), 10, args.ticks)
+                 for i in range(args.gaits)]
+    results = sweep(spec, variations, gaits, args.processes)
+    for result in sorted(results, key=lambda r: -r["mean"]):
+        values = " ".join("%s=%s" % item for item in result["values"].items())
+        print("%8.2f %8.2f  %s" % (result["mean"], result["best"], values or "(spec as given)"))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
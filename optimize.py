@@ -0,0 +1,214 @@
+"""
+Genetic algorithm search for periodic QWOP gaits
+
+A genome is a gait cycle of `slots` controls (replay.NONE, Q, W, O or P),
+each held for `slot_ticks` physics ticks, repeated for the whole episode.
+Candidates are scored by their distance in headless episodes that end as
+soon as the runner falls, evaluated across a process pool.
+
+With --cache-mb, workers resume episodes from cached states (see cache.py).
+Those scores are only estimates, since a resumed run can end meters away
+from a full one, so the elites and the reported best gait are scored again
+with full runs before they are kept, printed or saved.
+
+python3 optimize.py --generations 50 --population 512 --checkpoint ga.npz
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import numpy as np
+import cache
+import replay
+import world
+
+CONTROLS = 5 # replay.NONE, Q, W, O, P
+
+def expand(genome, slot_ticks, max_ticks):
+    """
+    Returns the per-tick controls for a genome
+    """
+    cycle = np.repeat(np.asarray(genome, np.uint8), slot_ticks)
+    return np.resize(cycle, max_ticks)
+
+def until_fallen(controls):
+    """
+    Returns controls cut after the tick on which the runner falls, so that
+    replay.py, which plays a recording to its end, gets the distance the
+    search scored with stop_when_fallen
+    """
+    space, character = world.setup_world()
+    for tick, code in enumerate(controls.tolist()):
+        replay.apply(character, code)
+        world.step(space)
+        if world.fallen(character):
+            return controls[:tick+1]
+    return controls
+
+# Per worker process, see init_worker
+_cache = None
+
+def init_worker(cache_bytes):
+    global _cache
+    if cache_bytes:
+        _cache = cache.PrefixCache(max_bytes=cache_bytes)
+
+def evaluate(args):
+    """
+    Returns (distance, ticks resumed from the worker's prefix cache)
+    """
+    genome, slot_ticks, max_ticks = args
+    controls = expand(genome, slot_ticks, max_ticks)
+    if _cache is None:
+        return replay.run(controls, stop_when_fallen=True), 0
+    return cache.run(_cache, controls, stop_when_fallen=True)
+
+def evaluate_exact(args):
+    """
+    Returns the distance of a full run from tick zero, as replay.py gets it
+    """
+    genome, slot_ticks, max_ticks = args
+    return replay.run(expand(genome, slot_ticks, max_ticks), stop_when_fallen=True)
+
+class GeneticSearch:
+
+    def __init__(self, population=256, slots=16, slot_ticks=10, max_ticks=1000,
+                 elite=0.05, tournament=4, mutation=0.05, seed=None):
+        """
+        population: (int) candidates per generation
+        slots: (int) controls per gait cycle
+        slot_ticks: (int) ticks each control is held
+        max_ticks: (int) longest episode
+        elite: (float) fraction of the best candidates copied unchanged
+        tournament: (int) candidates compared to pick each parent
+        mutation: (float) probability that a slot gets a random control
+        """
+        self.slots = slots
+        self.slot_ticks = slot_ticks
+        self.max_ticks = max_ticks
+        self.elite = max(1, int(elite*population))
+        self.tournament = tournament
+        self.mutation = mutation
+        self.rng = np.random.default_rng(seed)
+        self.population = self.rng.integers(0, CONTROLS, (population, slots), dtype=np.uint8)
+        self.fitness = None
+        self.reused = 0.0
+        self.generation = 0
+
+    def evaluate(self, pool):
+        """
+        Scores the whole population. imap with small chunks keeps every
+        worker busy even though episodes end at different times.
+        """
+        jobs = [(genome, self.slot_ticks, self.max_ticks) for genome in self.population]
+        chunk = max(1, len(jobs) // (os.cpu_count() * 8))
+        results = np.array(list(pool.imap(evaluate, jobs, chunk)))
+        self.fitness = results[:, 0]
+        self.reused = results[:, 1].sum() / (len(jobs)*self.max_ticks)
+        if results[:, 1].any():
+            self.rescore(pool)
+
+    def rescore(self, pool):
+        """
+        Replaces the cached-run fitness of the elites with that of full runs,
+        until the elites are all scored exactly
+        """
+        exact = np.zeros(len(self.population), bool)
+        while True:
+            top = np.argsort(-self.fitness)[:self.elite]
+            todo = top[~exact[top]]
+            if not len(todo):
+                break
+            jobs = [(self.population[i], self.slot_ticks, self.max_ticks) for i in todo]
+            self.fitness[todo] = pool.map(evaluate_exact, jobs)
+            exact[todo] = True
+
+    def breed(self):
+        """
+        Replaces the population with the next generation
+        """
+        order = np.argsort(-self.fitness)
+        count, slots = self.population.shape
+        children = np.empty_like(self.population)
+        children[:self.elite] = self.population[order[:self.elite]]
+
+        n = count - self.elite
+        a = self.select(n)
+        b = self.select(n)
+        mask = self.rng.random((n, slots)) < 0.5
+        children[self.elite:] = np.where(mask, self.population[a], self.population[b])
+
+        mutate = self.rng.random((n, slots)) < self.mutation
+        random = self.rng.integers(0, CONTROLS, (n, slots), dtype=np.uint8)
+        children[self.elite:] = np.where(mutate, random, children[self.elite:])
+
+        self.population = children
+        self.fitness = None
+        self.generation += 1
+
+    def select(self, n):
+        """
+        Returns n parent indices chosen by tournament
+        """
+        entrants = self.rng.integers(0, len(self.population), (n, self.tournament))
+        best = np.argmax(self.fitness[entrants], axis=1)
+        return entrants[np.arange(n), best]
+
+    def best(self):
+        i = np.argmax(self.fitness)
+        return self.population[i], self.fitness[i]
+
+    def save(self, path):
+        """
+        Checkpoints the population, written atomically
+        """
+        tmp = path + ".tmp.npz"
+        np.savez(tmp, population=self.population, generation=self.generation,
+                 slots=self.slots, slot_ticks=self.slot_ticks, max_ticks=self.max_ticks,
+                 rng=json.dumps(self.rng.bit_generator.state))
+        os.replace(tmp, path)
+
+    def load(self, path):
+        data = np.load(path)
+        self.population = data["population"]
+        self.generation = int(data["generation"])
+        self.slots = int(data["slots"])
+        self.slot_ticks = int(data["slot_ticks"])
+        self.max_ticks = int(data["max_ticks"])
+        self.rng.bit_generator.state = json.loads(str(data["rng"]))
+        self.fitness = None
+
+def main():
+    parser = argparse.ArgumentParser(description="Search for QWOP gaits")
+    parser.add_argument("--generations", type=int, default=50)
+    parser.add_argument("--population", type=int, default=256)
+    parser.add_argument("--slots", type=int, default=16)
+    parser.add_argument("--slot-ticks", type=int, default=10)
+    parser.add_argument("--max-ticks", type=int, default=1000)
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--cache-mb", type=float, default=0,
+                        help="per-worker prefix cache size; cached scores are estimates, elites are rescored in full")
+    parser.add_argument("--checkpoint", help="population file, resumed from if it exists")
+    parser.add_argument("--best", default="best.qwop", help="recording of the best gait, for replay.py")
+    args = parser.parse_args()
+
+    search = GeneticSearch(args.population, args.slots, args.slot_ticks, args.max_ticks, seed=args.seed)
+    if args.checkpoint and os.path.exists(args.checkpoint):
+        search.load(args.checkpoint)
+        print("resumed at generation", search.generation)
+
+    with multiprocessing.Pool(args.processes, init_worker, (int(args.cache_mb*1024*1024),)) as pool:
+        while search.generation < args.generations:
+            search.evaluate(pool)
+            genome, fitness = search.best()
+            print("generation %d best %.2f m mean %.2f m cache reuse %.0f%%"
+                  % (search.generation, fitness, search.fitness.mean(), search.reused*100))
+            replay.save(args.best, until_fallen(expand(genome, search.slot_ticks, search.max_ticks)))
+            search.breed()
+            if args.checkpoint:
+                search.save(args.checkpoint)
+
+if __name__ == "__main__":
+    main()
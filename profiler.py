@@ -0,0 +1,96 @@
+"""
+Per-phase frame timing with rolling percentiles
+
+Wrap each phase of a frame in profiler.phase(name) and call end_frame()
+once per frame. Percentiles are over the last `window` samples of each
+phase. With a stream file, every frame's phase totals are also written as
+one JSON line.
+"""
+
+import collections
+import json
+import time
+import numpy as np
+
+class Phase:
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *args):
+        self.profiler.add(self.name, time.perf_counter() - self.start)
+
+class Profiler:
+
+    def __init__(self, window=300, stream=None):
+        """
+        window: (int) samples kept per phase for percentiles
+        stream: (str) path of a JSON lines file to append frame records to
+        """
+        self.window = window
+        self.samples = collections.OrderedDict()
+        self.frame = collections.OrderedDict()
+        self.frames = 0
+        self.stream = open(stream, "a") if stream else None
+        self.phases = {}
+
+    def phase(self, name):
+        """
+        Returns a context manager that times its block as phase name
+        """
+        if name not in self.phases:
+            self.phases[name] = Phase(self, name)
+        return self.phases[name]
+
+    def add(self, name, seconds):
+        if name not in self.samples:
+            self.samples[name] = collections.deque(maxlen=self.window)
+        self.samples[name].append(seconds)
+        self.frame[name] = self.frame.get(name, 0.0) + seconds
+
+    def wrap(self, name, fn):
+        """
+        Returns fn timed as phase name, for callbacks such as collision handlers
+        """
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            result = fn(*args, **kwargs)
+            self.add(name, time.perf_counter() - start)
+            return result
+        return timed
+
+    def end_frame(self):
+        """
+        Closes the current frame, streaming its phase totals if enabled
+        """
+        self.frames += 1
+        if self.stream:
+            record = {"frame": self.frames, "time": time.time()}
+            record.update((name, seconds) for name, seconds in self.frame.items())
+            self.stream.write(json.dumps(record) + "\n")
+        self.frame.clear()
+
+    def percentiles(self, name, ps=(50, 95, 99)):
+        """
+        Returns the given percentiles of phase name in seconds
+        """
+        return np.percentile(self.samples[name], ps)
+
+    def summary(self, ps=(50, 95, 99)):
+        """
+        Returns lines of per-phase percentiles in milliseconds
+        """
+        lines = ["%-12s" % "phase" + "".join("%8s" % ("p%d" % p) for p in ps)]
+        for name in self.samples:
+            values = self.percentiles(name, ps) * 1000
+            lines.append("%-12s" % name + "".join("%8.3f" % v for v in values))
+        return lines
+
+    def close(self):
+        if self.stream:
+            self.stream.close()
+            self.stream = None
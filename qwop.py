@@ -4,23 +4,62 @@ QWOP clone written with pyglet and pymunk
 """
 
 import math
+import signal
+import sys
 import pymunk, pymunk.pyglet_util
-from pymunk.vec2d import Vec2d
 import pyglet
 from pyglet.window import key
-from character import Character
+from render import CharacterSprites, GhostSprites, SpaceRenderer, sprite_layout
+from character import BODY_STATE_SIZE
+from profiler import Profiler
+import replay
+import scenery
+import stream
+import trajectory
+import world
 from pyglet.math import Mat4
 from pyglet import shapes
 
 window = pyglet.window.Window()
-batch = pyglet.graphics.Batch()
+background_batch = pyglet.graphics.Batch()
+track_batch = pyglet.graphics.Batch()
+background = []
 fps_display = pyglet.window.FPSDisplay(window=window)
 label = pyglet.text.Label('0 meters',
                           font_name='Times New Roman',
                           font_size=24,
                           x=window.width//2, y=window.height*0.9,
                           anchor_x='center', anchor_y='center')
+overlay = pyglet.text.Label('', font_name='Courier New', font_size=10,
+                            x=10, y=window.height-10, width=window.width,
+                            anchor_x='left', anchor_y='top', multiline=True)
+# python3 qwop.py --metrics FILE streams per-frame phase timings to FILE
+metrics = sys.argv[sys.argv.index("--metrics")+1] if "--metrics" in sys.argv else None
+profiler = Profiler(stream=metrics)
+# python3 qwop.py --record FILE saves the controls of every tick for replay.py
+recording = sys.argv[sys.argv.index("--record")+1] if "--record" in sys.argv else None
+recorder = None
+# python3 qwop.py --stream FILE publishes body transforms for viewer.py
+streaming = sys.argv[sys.argv.index("--stream")+1] if "--stream" in sys.argv else None
+writer = None
+# python3 qwop.py --ghosts FILE... races against recorded runs: trajectory
+# files from trajectory.py or replay.py recordings
+ghost_paths = []
+if "--ghosts" in sys.argv:
+    for arg in sys.argv[sys.argv.index("--ghosts")+1:]:
+        if arg.startswith("--"):
+            break
+        ghost_paths.append(arg)
+ghosts = None # trajectory.Playback of the recorded runs
+ghost_sprites = None
+ghost_start = 0 # space.ticks when the live runner was last reset
+show_profile = False
 character = None
+sprites = None
+joints = None # debug view of bodies and constraints
+previous = None # body state before the last tick, for interpolation
+accumulator = 0.0
+MAX_TICKS = 5 # per frame; beyond this the game slows down instead of stalling
 qDown = False
 wDown = False
 oDown = False
@@ -51,11 +90,18 @@ def on_key_press(symbol, modifiers):
     global pDown
     global paused
     global debug_draw
+    global show_profile
+    global ghost_start
     qDown = wDown = oDown = pDown = False
     if symbol == key.ESCAPE:
         window.close()
     elif symbol == key.R:
         character.reset()
+        # nothing to interpolate from until the next tick
+        character.snapshot(previous)
+        ghost_start = space.ticks
+        if recorder:
+            recorder.reset()
     elif symbol == key.Q:
         qDown = True
     elif symbol == key.W:
@@ -70,66 +116,65 @@ def on_key_press(symbol, modifiers):
         paused = not paused
     elif symbol == key.D:
         debug_draw = not debug_draw
+    elif symbol == key.F:
+        show_profile = not show_profile
 
 def print_commands():
     print("SPACE: Pause simulation")
     print("S: Step simulation")
-    print("R: Reset character")
+    print("R: Reset character and ghosts")
     print("D: Toggle debug draw of physics objects")
+    print("F: Toggle frame phase timings")
     print("Q: Apply force to left thigh")
     print("W: Apply force to right thigh")
     print("O: Apply force to left calf")
     print("P: Apply force to right calf")
 
 def draw_rect(h1, h2, c1, c2):
+    """
+    Full-width band between heights h1 and h2 (fractions of the window
+    height) in screen space, shaded from color c1 to c2
+    """
     w = window.width
     h = window.height
 
-    lc = character.get_position()[0] - w//2
-    background = ((lc, h*h1), 
-                  (w+lc, h*h1),
-                  (w+lc, h*h2),
-                  (lc, h*h2))
+    background = ((0, h*h1), 
+                  (w, h*h1),
+                  (w, h*h2),
+                  (0, h*h2))
     colors = (c1[0],c1[1],c1[2],c1[3], 
               c1[0],c1[1],c1[2],c1[3], 
               c2[0],c2[1],c2[2],c2[3], 
               c2[0],c2[1],c2[2],c2[3])
-    obj = shapes.Polygon(*background, color=colors, batch=batch)
+    obj = shapes.Polygon(*background, color=colors, batch=background_batch)
     return [obj]
-    
 
-def draw_white_line(h):
+def draw_start():
+    """
+    Start marker, in world space so it scrolls with the view
+    """
     objs = []
-    objs += draw_rect(h, h+0.01, (255,255,255,255), (255,255,255,100))
-    objs += draw_rect(h-0.01, h, (255,255,255,100), (255,255,255,255))
+    for quad, colors in scenery.start_marker(window.width/2, window.height):
+        color = tuple(c for rgba in colors for c in rgba)
+        objs += [shapes.Polygon(*quad, color=color, batch=track_batch)]
     return objs
 
-def draw_start():
-    x = window.width/2
-    h = window.height
-    
-    w1 = 25
-    w2 = 10
-    line1 = ((x-w1, 10/h),
-             (x, 10/h),
-             (x, h*0.28),
-             (x-w2, h*0.28))
-    line2 = ((x, 10/h),
-             (x+w1, 10/h),
-             (x+w2, h*0.28),
-             (x, h*0.28))
-    color1 = (255,255,255,50, 
-              255,255,255,255, 
-              255,255,255,255, 
-              255,255,255,50)
-    color2 = (255,255,255,255, 
-              255,255,255,50, 
-              255,255,255,50, 
-              255,255,255,255)
+def build_background():
+    """
+    Builds the static scenery once. The bands only vary with height so they
+    are drawn in screen space; the start marker scrolls with the projection.
+    Only needs rebuilding when the window size changes.
+    """
+    global background
     objs = []
-    objs += [shapes.Polygon(*line1, color=color1, batch=batch)]
-    objs += [shapes.Polygon(*line2, color=color2, batch=batch)]
-    return objs
+    for h1, h2, c1, c2 in scenery.bands(window.height):
+        objs += draw_rect(h1, h2, c1, c2)
+    objs += draw_start()
+    background = objs
+
+@window.event
+def on_resize(width, height):
+    build_background()
 
 @window.event
 def on_draw():
@@ -137,87 +182,120 @@ def on_draw():
 
     w = window.width
     h = window.height
-    lc = character.get_position()[0] - w//2
+    alpha = accumulator / world.TICK
+    lc = interpolate_x(character.torso, alpha) - w//2
 
     pyglet.gl.glEnable(pyglet.gl.GL_BLEND)
     pyglet.gl.glBlendFunc(pyglet.gl.GL_SRC_ALPHA, pyglet.gl.GL_ONE_MINUS_SRC_ALPHA)
 
-    window.projection = Mat4.orthogonal_projection(lc, lc+w, 0, h, -1, 1)
-    
+    with profiler.phase("background"):
+        window.projection = Mat4.orthogonal_projection(0, w, 0, h, -1, 1)
+        background_batch.draw()
 
-    objs = []
-    objs += draw_rect(0.5, 1.0, (0,0,255,255), (0,0,50,255))
-    objs += draw_rect(0.45, 0.5, (0,200,0,255), (0,0,255,255))
-    objs += draw_rect(0.45, 0.35, (0,200,0,255), (0,200,0,255))
-    objs += draw_rect(0.35, 0.25, (0,200,0,255), (200,0,0,255))
-    objs += draw_rect(10/h, 0.25, (200,0,0,255), (200,0,0,255))
-    objs += draw_white_line(0.1)
-    objs += draw_white_line(0.2)
-    objs += draw_white_line(0.25)
-    objs += draw_white_line(0.28)
-    objs += draw_start()
-    batch.draw()
+        window.projection = Mat4.orthogonal_projection(lc, lc+w, 0, h, -1, 1)
+        track_batch.draw()
 
-    if debug_draw:
-        fps_display.draw()
-        options = pymunk.pyglet_util.DrawOptions()
-        space.debug_draw(options)
-    else:
-        character.draw()
+    if ghosts and not debug_draw:
+        with profiler.phase("ghosts"):
+            ghost_sprites.draw(ghosts.transforms(space.ticks - ghost_start, alpha), lc, lc+w)
+
+    with profiler.phase("character"):
+        if debug_draw:
+            fps_display.draw()
+            options = pymunk.pyglet_util.DrawOptions()
+            options.flags = options.DRAW_SHAPES | options.DRAW_COLLISION_POINTS
+            space.debug_draw(options)
+            joints.draw()
+        else:
+            sprites.draw(previous, alpha)
 
     # TODO DCJ
     window.projection = Mat4.orthogonal_projection(0, w, 0, h, -1, 1)
-    factor = 1.25/200
-    label.text = "%.1f meters"%(lc * factor)
-    label.draw()
+    with profiler.phase("label"):
+        text = "%.1f meters"%world.distance(character)
+        if label.text != text:
+            label.text = text
+        label.draw()
+
+    if show_profile:
+        overlay.draw()
+    profiler.end_frame()
+
+def update_overlay(dt):
+    if show_profile:
+        overlay.text = "\n".join(profiler.summary())
+
+def interpolate_x(body, alpha):
+    """
+    x of body between the last two ticks, matching what the sprites draw
+    """
+    x0 = previous[character.bodies.index(body)*BODY_STATE_SIZE]
+    return x0 + (body.position.x - x0)*alpha
 
 def step():
-    for x in range(10):
-        space.step(1/50/10/2)
+    character.snapshot(previous)
+    with profiler.phase("input"):
+        world.apply_controls(character, qDown, wDown, oDown, pDown)
+        if recorder:
+            recorder.record(replay.control(qDown, wDown, oDown, pDown))
+    world.step(space, profiler)
+    if writer:
+        writer.publish([character], space.ticks)
 
 def update(dt):
-    if qDown:
-        character.move_thighL()
-    elif wDown:
-        character.move_thighR()
-    elif oDown:
-        character.move_calfL()
-    elif pDown:
-        character.move_calfR()
-
-    if not paused:
-       step()
+    """
+    Runs as many fixed ticks as the elapsed time calls for, up to MAX_TICKS.
+    The remainder carries over and is used to interpolate the drawing.
+    """
+    global accumulator
+    if paused:
+        return
+
+    accumulator += dt
+    ticks = 0
+    while accumulator >= world.TICK and ticks < MAX_TICKS:
+        step()
+        accumulator -= world.TICK
+        ticks += 1
+    accumulator = min(accumulator, world.TICK)
 
 def setup_world():
-    space = pymunk.Space()
-    space.gravity = 0,-9820
-    space.damping = 0.99
-
-    handler = space.add_collision_handler(100, 1)
-    handler.begin = hit_ground
-
-    floorHeight = 10
-    floor = pymunk.Segment(space.static_body, Vec2d(-window.width*100,floorHeight), Vec2d(window.width*100,10), 1)
-    floor.friction = 10.3
-    floor.collision_type = 100
-    space.add(floor)
-
-    w = 100
-    h = 200
-    bodyx = window.width // 2
-    bodyy = floorHeight + h + h/8 + 10 
-    print("Body start", bodyx, bodyy)
     global character
-    character = Character(space, bodyx, bodyy, 100, 200)
-
+    global sprites
+    global joints
+    global previous
+    global recorder
+    global writer
+    global ghosts
+    global ghost_sprites
+    if recording:
+        recorder = replay.Recorder(recording, window.width)
+    space, character = world.setup_world(window.width, profiler)
+    if streaming:
+        writer = stream.StreamWriter(streaming)
+    sprites = CharacterSprites(character)
+    if ghost_paths:
+        ghosts = trajectory.Playback(ghost_paths, window.width)
+        ghost_sprites = GhostSprites(sprite_layout(character), ghosts.count)
+    joints = SpaceRenderer(space)
+    previous = character.snapshot()
     return space
 
-def hit_ground(arbiter, space, data):
-    print("hit ground!")
-    return True
-
 print_commands()
 space = setup_world()
-pyglet.clock.schedule_interval(update, 0.01)
-pyglet.app.run()
+build_background()
+pyglet.clock.schedule(update)
+pyglet.clock.schedule_interval(update_overlay, 0.5)
+# a terminated game still closes its files, so a recording is not lost
+signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+try:
+    pyglet.app.run()
+finally:
+    if recorder:
+        recorder.close()
+    if writer:
+        writer.close()
+    if ghosts:
+        ghosts.close()
+    profiler.close()
 
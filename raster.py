@@ -0,0 +1,169 @@
+"""
+Software renderer for pixel observations
+
+Draws the same scene as qwop.py (background bands, white lines, start
+marker and the ragdoll sprites, posed like render.CharacterSprites) into
+NumPy images, with no GL context, for headless machines.
+
+pyglet's Polygon shape takes only the first color it is given, so the game
+draws each band and marker quad in one flat color. This renderer matches
+what the game shows rather than the per-vertex colors in scenery.py.
+"""
+
+import math
+import os
+import numpy as np
+from pyglet.extlibs import png
+import scenery
+import world
+from morphology import ROOT, rotate
+
+_images = {}
+
+class Rasterizer:
+
+    def __init__(self, width=160, height=120, view=(world.WIDTH, world.HEIGHT)):
+        """
+        width, height: (int) output image size in pixels
+        view: (w, h) size of the game view in world units that the image
+              covers, as the game window does
+        """
+        self.width = width
+        self.height = height
+        self.view = view
+        self.sx = width / view[0]
+        self.sy = height / view[1]
+        self.background = self.render_background()
+        self.frame = np.empty((height, width, 3), np.float32)
+
+    def render_background(self):
+        """
+        Bands only vary with height and the view does not scroll vertically,
+        so the background is drawn once per resolution
+        """
+        image = np.zeros((self.height, self.width, 3), np.float32)
+        h = self.view[1]
+        for h1, h2, c1, c2 in scenery.bands(h):
+            lo, hi = sorted((h1*h, h2*h))
+            rows = slice(self.row(hi), self.row(lo))
+            blend(image[rows], np.array(c1[:3], np.float32), c1[3]/255)
+        return image
+
+    def row(self, y):
+        """
+        Image row of the pixel boundary at world height y
+        """
+        return int(np.clip(round(self.height - y*self.sy), 0, self.height))
+
+    def render(self, character, out=None):
+        """
+        Returns an (height, width, 3) uint8 image of character, following it
+        the way the game camera does. Written into out when given.
+        """
+        if out is None:
+            out = np.empty((self.height, self.width, 3), np.uint8)
+        frame = self.frame
+        frame[:] = self.background
+
+        lc = character.get_position()[0] - self.view[0]//2
+        startx = character.torso.start_position[0]
+        for quad, colors in scenery.start_marker(startx, self.view[1]):
+            self.fill_quad(frame, quad, colors[0], lc)
+
+        for body in character.bodies:
+            angle = body.angle
+            ox, oy = rotate(angle, body.offset)
+            x, y = body.position
+            self.draw_sprite(frame, load_image(body.sprite), x + ox, y + oy, angle, lc)
+
+        np.copyto(out, frame, casting="unsafe")
+        return out
+
+    def render_batch(self, characters, out=None):
+        """
+        Returns (len(characters), height, width, 3) uint8 images
+        """
+        if out is None:
+            out = np.empty((len(characters), self.height, self.width, 3), np.uint8)
+        for i, character in enumerate(characters):
+            self.render(character, out[i])
+        return out
+
+    def pixels(self, x0, y0, x1, y1, lc):
+        """
+        Returns (rows, cols, wx, wy): the image slices covering the world
+        box (x0, y0)-(x1, y1) and the world coordinates of their pixel centers
+        """
+        c0 = int(np.clip(math.floor((x0 - lc)*self.sx), 0, self.width))
+        c1 = int(np.clip(math.ceil((x1 - lc)*self.sx), 0, self.width))
+        r0 = self.row(y1)
+        r1 = self.row(y0)
+        wx = lc + (np.arange(c0, c1, dtype=np.float32) + 0.5) / self.sx
+        wy = (self.height - np.arange(r0, r1, dtype=np.float32) - 0.5) / self.sy
+        return slice(r0, r1), slice(c0, c1), wx[None, :], wy[:, None]
+
+    def fill_quad(self, frame, quad, color, lc):
+        """
+        Blends a convex quad in world coordinates, in one flat color
+        """
+        xs = [p[0] for p in quad]
+        ys = [p[1] for p in quad]
+        rows, cols, wx, wy = self.pixels(min(xs), min(ys), max(xs), max(ys), lc)
+        if wx.size == 0 or wy.size == 0:
+            return
+        inside = np.ones((wy.shape[0], wx.shape[1]), bool)
+        for i in range(4):
+            ax, ay = quad[i]
+            bx, by = quad[(i+1) % 4]
+            inside &= (bx - ax)*(wy - ay) - (by - ay)*(wx - ax) >= 0
+        blend(frame[rows, cols], np.array(color[:3], np.float32), inside*(color[3]/255))
+
+    def draw_sprite(self, frame, image, cx, cy, angle, lc):
+        """
+        Blends image centered on (cx, cy) and rotated counterclockwise by
+        angle, sampled with nearest neighbour
+        """
+        ih, iw = image.shape[:2]
+        r = math.hypot(iw, ih) / 2
+        rows, cols, wx, wy = self.pixels(cx - r, cy - r, cx + r, cy + r, lc)
+        if wx.size == 0 or wy.size == 0:
+            return
+        c = math.cos(angle)
+        s = math.sin(angle)
+        dx = wx - cx
+        dy = wy - cy
+        u = np.floor(c*dx + s*dy + iw//2).astype(np.int32)
+        v = np.floor(-s*dx + c*dy + ih//2).astype(np.int32)
+        inside = (u >= 0) & (u < iw) & (v >= 0) & (v < ih)
+        u = np.where(inside, u, 0)
+        v = np.where(inside, ih - 1 - v, 0)
+        texels = image[v, u]
+        blend(frame[rows, cols], texels[..., :3], texels[..., 3] * inside)
+
+def blend(dst, color, alpha):
+    """
+    Source-over blend of color into dst in place; alpha in [0, 1]
+    """
+    alpha = np.asarray(alpha, np.float32)
+    if alpha.ndim:
+        alpha = alpha[..., None]
+    dst += (color - dst) * alpha
+
+def load_image(name):
+    """
+    Returns the image at name, relative to the project, as a float32 array
+    of shape (h, w, 4) with color in [0, 255] and alpha in [0, 1]
+    """
+    if name not in _images:
+        image = load_png(os.path.join(ROOT, name)).astype(np.float32)
+        image[..., 3] /= 255
+        _images[name] = image
+    return _images[name]
+
+def load_png(path):
+    """
+    Decodes a PNG into a uint8 array of shape (h, w, 4) with pypng, which
+    pyglet ships and which needs no GL context
+    """
+    w, h, rows, info = png.Reader(filename=path).asRGBA8()
+    return np.array(list(rows), np.uint8).reshape(h, w, 4)
@@ -0,0 +1,420 @@
+"""
+pyglet drawing for the ragdoll character and debug views of pymunk spaces
+
+All character images are packed into one texture atlas and every sprite is
+drawn through a batch, with one ordered group per body layer. Sprites in the
+same layer share a texture and group, so a batch holding many runners costs
+one draw call per layer instead of one per sprite. SpaceRenderer does the
+same for bodies and constraints.
+"""
+
+import glob
+import math
+import os
+import numpy as np
+import pyglet
+import pymunk
+import pymunk.batch
+from character import BODY_STATE_SIZE
+from morphology import ROOT, rotate
+
+# One group per entry in Character.bodies, in draw order. Shared by every
+# runner so sprites of the same layer end up in the same draw call.
+LAYERS = [pyglet.graphics.Group(order=i) for i in range(8)]
+
+_atlas = None
+_images = {}
+
+class CharacterSprites:
+
+    def __init__(self, character, batch=None):
+        """
+        batch: (Batch) batch to add the sprites to. Pass the same batch for
+               several runners and draw it once after calling update() on
+               each. Layers are shared, so with several runners all of their
+               right legs are drawn before any torso.
+        """
+        self.character = character
+        self.own_batch = batch is None
+        self.batch = pyglet.graphics.Batch() if batch is None else batch
+        self.sprites = [load_sprite(body.sprite, body, body.offset, self.batch, LAYERS[i])
+                        for i, body in enumerate(character.bodies)]
+
+    def update(self, previous=None, alpha=1.0):
+        """
+        Moves the sprites to the current body transforms
+        previous: (array) Character.snapshot taken before the last tick; when
+                  given, transforms are interpolated from it by alpha in [0, 1]
+        """
+        for i, graphic in enumerate(self.sprites):
+            x, y = graphic.body.position
+            angle = graphic.body.angle
+            if previous is not None:
+                j = i*BODY_STATE_SIZE
+                x = previous[j] + (x - previous[j])*alpha
+                y = previous[j+1] + (y - previous[j+1])*alpha
+                angle = previous[j+2] + (angle - previous[j+2])*alpha
+            place(graphic, x, y, angle)
+
+    def draw(self, previous=None, alpha=1.0):
+        self.update(previous, alpha)
+        if self.own_batch:
+            self.batch.draw()
+
+    def delete(self):
+        for graphic in self.sprites:
+            graphic.delete()
+        self.sprites = []
+
+class PoseSprites:
+    """
+    Sprites of one runner posed from stored body transforms, such as frames
+    read from stream.py, instead of from live pymunk bodies
+    """
+
+    def __init__(self, layout, batch=None, opacity=255):
+        """
+        layout: (list) (image name, offset) for each body in Character.bodies
+                order, see sprite_layout
+        batch: (Batch) as for CharacterSprites
+        opacity: (int) 0 to 255
+        """
+        self.own_batch = batch is None
+        self.batch = pyglet.graphics.Batch() if batch is None else batch
+        self.sprites = [load_sprite(name, None, offset, self.batch, LAYERS[i])
+                        for i, (name, offset) in enumerate(layout)]
+        for graphic in self.sprites:
+            graphic.opacity = opacity
+
+    def update(self, transforms):
+        """
+        transforms: (array) one (x, y, angle) row per body
+        """
+        for graphic, (x, y, angle) in zip(self.sprites, transforms.tolist()):
+            place(graphic, x, y, angle)
+
+    def draw(self, transforms):
+        self.update(transforms)
+        if self.own_batch:
+            self.batch.draw()
+
+    def delete(self):
+        for graphic in self.sprites:
+            graphic.delete()
+        self.sprites = []
+
+class GhostSprites:
+    """
+    Many translucent runners posed from recorded transforms, such as rows
+    of a trajectory file, with no physics behind them
+
+    Sprites are not pyglet Sprite objects: each layer of every ghost is a
+    quad in one indexed vertex list per layer, drawn with the sprite shader,
+    so any number of ghosts costs one draw call per layer and one NumPy
+    write per attribute per frame. Ghosts outside the view are culled by
+    scaling their quads to nothing.
+    """
+
+    def __init__(self, layout, count, batch=None, opacity=80, margin=300):
+        """
+        layout: (list) as for PoseSprites
+        count: (int) number of ghosts
+        batch: (Batch) as for CharacterSprites
+        opacity: (int) 0 to 255
+        margin: (float) how far past its torso a ghost's sprites can reach,
+                for culling
+        """
+        self.count = count
+        self.margin = margin
+        self.own_batch = batch is None
+        self.batch = pyglet.graphics.Batch() if batch is None else batch
+        program = pyglet.sprite.get_default_shader()
+        indices = (np.arange(count)[:, None]*4 + [0, 1, 2, 0, 2, 3]).ravel().tolist()
+        self.lists = []
+        self.offsets = []
+        for i, (name, offset) in enumerate(layout):
+            image = atlas_image(name)
+            group = pyglet.sprite.SpriteGroup(image.get_texture(), pyglet.gl.GL_SRC_ALPHA,
+                                              pyglet.gl.GL_ONE_MINUS_SRC_ALPHA, program, LAYERS[i])
+            x1, y1 = -image.anchor_x, -image.anchor_y
+            x2, y2 = x1 + image.width, y1 + image.height
+            corners = (x1, y1, 0, x2, y1, 0, x2, y2, 0, x1, y2, 0)
+            self.lists.append(program.vertex_list_indexed(4*count, pyglet.gl.GL_TRIANGLES, indices, self.batch, group,
+                position=('f', corners*count),
+                colors=('Bn', (255, 255, 255, opacity)*4*count),
+                translate=('f', np.zeros(12*count)),
+                scale=('f', np.zeros(8*count)),
+                rotation=('f', np.zeros(4*count)),
+                tex_coords=('f', image.tex_coords*count)))
+            self.offsets.append(offset)
+        self.offsets = np.array(self.offsets, dtype=np.float64)
+        self.visible = np.zeros(count, dtype=bool)
+
+    def update(self, transforms, left, right):
+        """
+        transforms: (array) shape (count, bodies, 3) of (x, y, angle)
+        left, right: (float) world x range in view; ghosts entirely outside
+                     it are hidden
+        """
+        x = transforms[:, :, 0]
+        visible = (x.max(axis=1) + self.margin > left) & (x.min(axis=1) - self.margin < right)
+        if not np.array_equal(visible, self.visible):
+            self.visible = visible
+            scale = np.repeat(visible.astype(np.float32), 8)
+            for vertex_list in self.lists:
+                write_attribute(vertex_list, "scale", scale)
+        if not visible.any():
+            return
+        angles = transforms[:, :, 2]
+        c, s = np.cos(angles), np.sin(angles)
+        ox, oy = self.offsets[:, 0], self.offsets[:, 1]
+        translate = np.zeros((self.count, 4, 3), dtype=np.float32)
+        for i, vertex_list in enumerate(self.lists):
+            translate[:, :, 0] = (x[:, i] + c[:, i]*ox[i] - s[:, i]*oy[i])[:, None]
+            translate[:, :, 1] = (transforms[:, i, 1] + s[:, i]*ox[i] + c[:, i]*oy[i])[:, None]
+            write_attribute(vertex_list, "translate", translate)
+            write_attribute(vertex_list, "rotation", np.repeat(angles[:, i]*(-180/math.pi), 4))
+
+    def draw(self, transforms, left, right):
+        self.update(transforms, left, right)
+        if self.own_batch:
+            self.batch.draw()
+
+    def delete(self):
+        for vertex_list in self.lists:
+            vertex_list.delete()
+        self.lists = []
+
+def sprite_layout(character):
+    """
+    Returns the (image name, offset) of each body of character, for PoseSprites
+    """
+    return [(body.sprite, body.offset) for body in character.bodies]
+
+def place(graphic, x, y, angle):
+    """
+    Moves a sprite to its body's transform, shifted by the sprite's offset
+    from the body center
+    """
+    offset = rotate(angle, graphic.offset)
+    graphic.position = (x + offset[0], y + offset[1], 0) # TODO DCJ
+    graphic.rotation = -angle * 180 / math.pi
+
+# Fields of the bulk body export used by SpaceRenderer, one row per body
+_FIELDS = pymunk.batch.BodyFields.BODY_ID | pymunk.batch.BodyFields.POSITION | pymunk.batch.BodyFields.ANGLE
+
+class PointGroup(pyglet.graphics.ShaderGroup):
+    """
+    Shader group that draws GL_POINTS at a fixed size
+    """
+
+    def __init__(self, size, program, order=0):
+        super().__init__(program, order)
+        self.size = size
+
+    def set_state(self):
+        super().set_state()
+        pyglet.gl.glPointSize(self.size)
+
+    def unset_state(self):
+        pyglet.gl.glPointSize(1)
+        super().unset_state()
+
+    def __eq__(self, other):
+        return super().__eq__(other) and self.size == other.size
+
+    def __hash__(self):
+        return hash((super().__hash__(), self.size))
+
+class SpaceRenderer:
+    """
+    Debug view of every body and constraint in a pymunk space
+
+    Vertex lists are allocated once and rewritten in place each frame from a
+    single bulk export of body positions, so a scene is three draw calls no
+    matter how many bodies and springs it holds: body points, constraint
+    lines between anchors, and pivot points. Lists are reallocated only when
+    bodies or constraints are added or removed.
+    """
+
+    colors = {
+        "dynamic": (200, 200, 200, 255),
+        "static": (255, 0, 255, 255),
+        "constraint": (90, 90, 90, 255),
+        "pivot": (255, 60, 0, 255),
+    }
+
+    def __init__(self, space, batch=None, point_size=4, pivot_size=6, colors=None):
+        """
+        space: (pymunk.Space) space to draw; bodies that are only reachable
+               through a constraint (e.g. static attach points not added to
+               the space) are drawn too
+        batch: (Batch) batch to add the vertex lists to; when None, draw()
+               draws a batch of its own
+        colors: (dict) overrides for the entries of SpaceRenderer.colors
+        """
+        self.space = space
+        self.own_batch = batch is None
+        self.batch = pyglet.graphics.Batch() if batch is None else batch
+        self.colors = dict(SpaceRenderer.colors, **(colors or {}))
+        program = pyglet.graphics.get_default_shader()
+        self.program = program
+        self.line_group = pyglet.graphics.ShaderGroup(program, order=0)
+        self.point_group = PointGroup(point_size, program, order=1)
+        self.pivot_group = PointGroup(pivot_size, program, order=2)
+        self.buffer = pymunk.batch.Buffer()
+        self.lists = []
+        self.ids = None
+        self.num_constraints = -1
+
+    def rebuild(self, ids):
+        """
+        Maps bodies and constraints to rows of the exported state and
+        reallocates the vertex lists
+        ids: (array) body ids in export order
+        """
+        self.delete()
+        self.ids = ids.copy()
+        self.num_constraints = len(self.space.constraints)
+        row = {body_id: i for i, body_id in enumerate(ids)}
+        extra = []
+
+        def lookup(body):
+            if body.id not in row:
+                row[body.id] = len(ids) + len(extra)
+                extra.append(body)
+            return row[body.id]
+
+        bodies = list(self.space.bodies)
+        body_rows = [lookup(body) for body in bodies]
+        constraints = self.space.constraints
+        self.a = np.array([lookup(c.a) for c in constraints], dtype=np.intp)
+        self.b = np.array([lookup(c.b) for c in constraints], dtype=np.intp)
+        self.anchor_a = np.array([getattr(c, "anchor_a", (0, 0)) for c in constraints], dtype=np.float64).reshape(-1, 2)
+        self.anchor_b = np.array([getattr(c, "anchor_b", (0, 0)) for c in constraints], dtype=np.float64).reshape(-1, 2)
+        self.pivots = np.array([i for i, c in enumerate(constraints) if isinstance(c, pymunk.PivotJoint)], dtype=np.intp)
+        self.extra = extra
+
+        # bodies reached only through a constraint are drawn after the ones
+        # in the space; their transforms are read one by one each frame
+        self.body_rows = np.array(body_rows + list(range(len(ids), len(ids) + len(extra))), dtype=np.intp)
+        types = [0 if body.body_type == pymunk.Body.DYNAMIC else 1 for body in bodies + extra]
+        self.state = np.zeros((len(ids) + len(extra), 3))
+
+        count = len(self.body_rows)
+        palette = np.array([self.colors["dynamic"], self.colors["static"]], dtype=np.uint8)
+        self.points = self.program.vertex_list(count, pyglet.gl.GL_POINTS, self.batch, self.point_group,
+            position=('f', np.zeros(count*3)), colors=('Bn', palette[types].ravel()))
+        count = 2*len(constraints)
+        self.lines = self.program.vertex_list(count, pyglet.gl.GL_LINES, self.batch, self.line_group,
+            position=('f', np.zeros(count*3)), colors=('Bn', self.colors["constraint"]*count))
+        count = len(self.pivots)
+        self.pivot_points = self.program.vertex_list(count, pyglet.gl.GL_POINTS, self.batch, self.pivot_group,
+            position=('f', np.zeros(count*3)), colors=('Bn', self.colors["pivot"]*count))
+        self.lists = [self.points, self.lines, self.pivot_points]
+
+    def export(self):
+        """
+        Returns the (x, y, angle) of every drawn body, one row each
+        """
+        self.buffer.clear()
+        pymunk.batch.get_space_bodies(self.space, _FIELDS, self.buffer)
+        ids = np.frombuffer(self.buffer.int_buf(), dtype=np.uintp)
+        if (self.ids is None or not np.array_equal(ids, self.ids)
+                or len(self.space.constraints) != self.num_constraints):
+            self.rebuild(ids)
+        n = len(ids)
+        self.state[:n] = np.frombuffer(self.buffer.float_buf()).reshape(n, 3)
+        for i, body in enumerate(self.extra):
+            self.state[n+i] = (body.position.x, body.position.y, body.angle)
+        return self.state
+
+    def update(self):
+        """
+        Rewrites the vertex lists from the current body transforms
+        """
+        state = self.export()
+        write_positions(self.points, state[self.body_rows, :2])
+        a, b = state[self.a], state[self.b]
+        ends = np.empty((len(a), 2, 2))
+        ends[:, 0] = a[:, :2] + rotate_all(a[:, 2], self.anchor_a)
+        ends[:, 1] = b[:, :2] + rotate_all(b[:, 2], self.anchor_b)
+        write_positions(self.lines, ends.reshape(-1, 2))
+        write_positions(self.pivot_points, ends[self.pivots, 0])
+
+    def draw(self):
+        self.update()
+        if self.own_batch:
+            self.batch.draw()
+
+    def delete(self):
+        for vertex_list in self.lists:
+            vertex_list.delete()
+        self.lists = []
+
+def rotate_all(angles, points):
+    """
+    Rotates each row of points (n, 2) by the matching angle (n,)
+    """
+    c, s = np.cos(angles), np.sin(angles)
+    x, y = points[:, 0], points[:, 1]
+    return np.stack([c*x - s*y, s*x + c*y], axis=1)
+
+def write_positions(vertex_list, xy):
+    """
+    Writes 2D positions into the position attribute of vertex_list in place
+    xy: (array) one (x, y) row per vertex
+    """
+    if vertex_list.count == 0:
+        return
+    buffer = vertex_list.domain.attrib_name_buffers["position"]
+    start = buffer.count * vertex_list.start
+    view = np.ctypeslib.as_array(buffer.data)[start:start + buffer.count*vertex_list.count]
+    view = view.reshape(vertex_list.count, buffer.count)
+    view[:, :2] = xy
+    buffer.invalidate_region(vertex_list.start, vertex_list.count)
+
+def write_attribute(vertex_list, name, values):
+    """
+    Overwrites attribute name of every vertex in vertex_list in place
+    values: (array) all components of every vertex, in order
+    """
+    buffer = vertex_list.domain.attrib_name_buffers[name]
+    start = buffer.count * vertex_list.start
+    view = np.ctypeslib.as_array(buffer.data)[start:start + buffer.count*vertex_list.count]
+    view[:] = np.ravel(values)
+    buffer.invalidate_region(vertex_list.start, vertex_list.count)
+
+def load_atlas(pattern="assets/*.png"):
+    """
+    Packs every image matching pattern into a shared texture atlas
+    """
+    global _atlas
+    if _atlas is None:
+        _atlas = pyglet.image.atlas.TextureBin(1024, 1024)
+    for name in sorted(glob.glob(os.path.join(ROOT, pattern))):
+        name = os.path.relpath(name, ROOT).replace(os.sep, "/")
+        atlas_image(name)
+
+def atlas_image(name):
+    """
+    Returns the atlas region for name, centered on its anchor
+    """
+    if _atlas is None:
+        load_atlas()
+    if name not in _images:
+        image = pyglet.image.load(os.path.join(ROOT, name))
+        region = _atlas.add(image, border=1)
+        region.anchor_x = region.width // 2
+        region.anchor_y = region.height // 2
+        _images[name] = region
+    return _images[name]
+
+# https://pyglet.readthedocs.io/en/latest/modules/sprite.html
+def load_sprite(name, body, offset=(0,0), batch=None, group=None):
+    image = atlas_image(name)
+    sprite = pyglet.sprite.Sprite(image, batch=batch, group=group)
+    #sprite.scale = body.height / (image.height)
+    sprite.body = body
+    sprite.offset = offset
+    return sprite
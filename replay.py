@@ -0,0 +1,136 @@
+"""
+Deterministic input recording and headless replay
+
+A recording stores the control that was active on every physics tick, one
+byte per tick, after a small header. Replaying feeds those controls through
+world.apply_controls and world.step in a fresh world, as fast as the CPU
+allows, and reproduces the recorded run exactly.
+
+python3 replay.py run1.qwop run2.qwop ...   prints the distance of each run
+"""
+
+import multiprocessing
+import struct
+import sys
+import numpy as np
+import world
+
+MAGIC = b"QWOP"
+VERSION = 1
+HEADER = struct.Struct("<4sHH") # magic, version, world width
+
+# Control codes, one per tick. The RESET bit is set on ticks where the
+# runner was put back at its start before the tick, as the R key does.
+NONE, Q, W, O, P = range(5)
+RESET = 0x80
+
+def control(q, w, o, p):
+    """
+    Returns the code for the key that acts this tick, with the same
+    priority as world.apply_controls
+    """
+    if q:
+        return Q
+    elif w:
+        return W
+    elif o:
+        return O
+    elif p:
+        return P
+    return NONE
+
+def keys(code):
+    """
+    Returns the (q, w, o, p) key states of a code, ignoring its RESET bit
+    """
+    code &= ~RESET
+    return code == Q, code == W, code == O, code == P
+
+def apply(character, code):
+    """
+    Plays one tick's code on character: puts it back at its start if the
+    RESET bit is set, then applies the key. Call world.step afterwards.
+    """
+    if code & RESET:
+        character.reset()
+    world.apply_controls(character, *keys(code))
+
+class Recorder:
+
+    def __init__(self, path, width=world.WIDTH):
+        self.file = open(path, "wb")
+        self.file.write(HEADER.pack(MAGIC, VERSION, width))
+        self.pending_reset = False
+
+    def reset(self):
+        """
+        Marks that the runner was reset before the next recorded tick
+        """
+        self.pending_reset = True
+
+    def record(self, code):
+        """
+        Records the control applied on one physics tick
+        """
+        if self.pending_reset:
+            code |= RESET
+            self.pending_reset = False
+        self.file.write(bytes((code,)))
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def save(path, controls, width=world.WIDTH):
+    """
+    Writes a controls array as a recording
+    """
+    with Recorder(path, width) as recorder:
+        recorder.file.write(np.asarray(controls, np.uint8).tobytes())
+
+def load(path):
+    """
+    Returns (width, controls) where controls is a uint8 array, one per tick
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    magic, version, width = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("%s is not a version %d QWOP recording" % (path, VERSION))
+    return width, np.frombuffer(data, np.uint8, offset=HEADER.size)
+
+def run(controls, width=world.WIDTH, stop_when_fallen=False):
+    """
+    Simulates controls in a new world and returns the final distance in meters
+    stop_when_fallen: (bool) end the run early once world.fallen is true
+    """
+    space, character = world.setup_world(width)
+    for code in controls.tolist():
+        apply(character, code)
+        world.step(space)
+        if stop_when_fallen and world.fallen(character):
+            break
+    return world.distance(character)
+
+def replay(path):
+    """
+    Returns the final distance of the recording at path
+    """
+    width, controls = load(path)
+    return run(controls, width)
+
+def replay_many(paths, processes=None):
+    """
+    Replays every recording across a process pool, returning their distances
+    """
+    with multiprocessing.Pool(processes) as pool:
+        return pool.map(replay, paths)
+
+if __name__ == "__main__":
+    for path, distance in zip(sys.argv[1:], replay_many(sys.argv[1:])):
+        print("%s %.17g" % (path, distance))
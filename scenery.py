@@ -0,0 +1,53 @@
+"""
+Geometry and colors of the track scenery
+
+Shared by the pyglet game (qwop.py) and the software renderer (raster.py),
+so this module imports neither.
+"""
+
+WHITE = (255,255,255,255)
+FADED = (255,255,255,100)
+
+def bands(h):
+    """
+    Returns the full-width bands of the background as (h1, h2, c1, c2):
+    heights as fractions of the view height h, shaded from RGBA color c1
+    at h1 to c2 at h2, in draw order
+    """
+    objs = [(0.5, 1.0, (0,0,255,255), (0,0,50,255)),
+            (0.45, 0.5, (0,200,0,255), (0,0,255,255)),
+            (0.45, 0.35, (0,200,0,255), (0,200,0,255)),
+            (0.35, 0.25, (0,200,0,255), (200,0,0,255)),
+            (10/h, 0.25, (200,0,0,255), (200,0,0,255))]
+    for y in (0.1, 0.2, 0.25, 0.28):
+        objs += white_line(y)
+    return objs
+
+def white_line(h):
+    return [(h, h+0.01, WHITE, FADED),
+            (h-0.01, h, FADED, WHITE)]
+
+def start_marker(x, h):
+    """
+    Returns the start marker at world x as a list of (quad, colors), each a
+    4-point polygon with one RGBA color per point, in world coordinates
+    """
+    w1 = 25
+    w2 = 10
+    line1 = ((x-w1, 10/h),
+             (x, 10/h),
+             (x, h*0.28),
+             (x-w2, h*0.28))
+    line2 = ((x, 10/h),
+             (x+w1, 10/h),
+             (x+w2, h*0.28),
+             (x, h*0.28))
+    color1 = ((255,255,255,50), 
+              (255,255,255,255), 
+              (255,255,255,255), 
+              (255,255,255,50))
+    color2 = ((255,255,255,255), 
+              (255,255,255,50), 
+              (255,255,255,50), 
+              (255,255,255,255))
+    return [(line1, color1), (line2, color2)]
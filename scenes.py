@@ -0,0 +1,213 @@
+"""
+Headless stress scenes rebuilt from the demos in examples/
+
+Each builder returns a pymunk.Space with no window attached, sized by its
+arguments, so the same scene can be stepped at many sizes by stress.py.
+Spaces carry the step size their demo uses as space.tick.
+"""
+
+import math
+import pymunk
+from pymunk.vec2d import Vec2d
+
+def stack(columns=5, rows=10, size=20):
+    """
+    Columns of boxes resting on a floor, from box2d_vertical_stack.py
+    columns: (int) number of stacks, 50 units apart
+    rows: (int) boxes per stack
+    size: (float) box side length
+    """
+    space = pymunk.Space()
+    space.gravity = 0, -900
+    space.sleep_time_threshold = 0.3
+    space.tick = 1/250
+
+    right = 300 + columns*50 + 250
+    floor = pymunk.Segment(space.static_body, (20, 55), (right, 55), 1)
+    wall = pymunk.Segment(space.static_body, (right - 50, 55), (right - 50, 400), 1)
+    floor.friction = wall.friction = 0.3
+    space.add(floor, wall)
+
+    for x in range(columns):
+        for y in range(rows):
+            mass = 10.0
+            body = pymunk.Body(mass, pymunk.moment_for_box(mass, (size, size)))
+            body.position = 300 + x*50, 105 + y*(size + .1)
+            shape = pymunk.Poly.create_box(body, (size, size))
+            shape.friction = 0.3
+            space.add(body, shape)
+    return space
+
+def cradle(balls=5, radius=25):
+    """
+    Row of balls hanging from pin joints with the first one pushed,
+    from newtonsCradle.py
+    balls: (int) number of balls
+    radius: (float) ball radius; balls touch at rest
+    """
+    space = pymunk.Space()
+    space.gravity = 0, -9820
+    space.damping = 0.99
+    space.tick = 1/50/10/2
+
+    for i in range(balls):
+        mass = 10
+        body = pymunk.Body(mass, pymunk.moment_for_circle(mass, 0, radius, (0, 0)))
+        x = i*2*radius
+        body.position = x, -125
+        shape = pymunk.Circle(body, radius)
+        shape.elasticity = 0.9999999
+        space.add(body, shape)
+        space.add(pymunk.PinJoint(space.static_body, body, (x, 125), (0, 0)))
+        if i == 0:
+            body.apply_impulse_at_local_point((-12000, 0))
+    return space
+
+def web(rings=5, spokes=20, center=(320, 240), radius=240):
+    """
+    Elastic spiderweb of damped springs pinned at its rim, from spiderweb.py
+    rings: (int) turns of the spiral; the demo has 5
+    spokes: (int) crossings per turn
+    center: (Vec2d) center of the web
+    radius: (float) scale of the web, half the demo window height
+    Returns the space; the crossings are space.web and the static attach
+    points, which are not added to the space, are space.attach_points.
+    """
+    space = pymunk.Space()
+    space.gravity = 0, -900
+    space.damping = .999
+    space.tick = 1/30/10
+    center = Vec2d(*center)
+    group = 1
+
+    hub = pymunk.Body(1, 1)
+    hub.position = center
+    shape = pymunk.Circle(hub, 15) # to have something to grab
+    shape.filter = pymunk.ShapeFilter(group=group)
+    space.add(hub, shape)
+
+    bodies = []
+    dist = .3
+    angle = 360/spokes
+    scale = radius / 6. * .5
+    # the spiral grows per crossing so any number of rings spans the same
+    # radius as the demo's 5; with rings=5 it is the demo's web
+    growth = 5 / rings
+    for x in range(rings*spokes + 1):
+        b = pymunk.Body(1, 1)
+        dist += growth/18.
+        dist = dist ** (1 + .005*growth)
+        offset = [0.0, -0.80, -1.0, -0.80][int(x*angle % 360 // angle) % 4]
+        offset = (.8 + offset) * dist**2.8 / 100.
+        b.position = center + Vec2d(1, 0).rotated_degrees(x*angle).scale_to_length(scale*(dist + offset))
+        shape = pymunk.Circle(b, 15)
+        shape.filter = pymunk.ShapeFilter(group=group)
+        space.add(b, shape)
+        bodies.append(b)
+
+    def add_spring(a, b):
+        rest = a.position.get_distance(b.position) * 0.9
+        spring = pymunk.DampedSpring(a, b, (0, 0), (0, 0), rest, 5000., 100)
+        spring.max_bias = 1000
+        space.add(spring)
+
+    for b in bodies[:spokes]:
+        add_spring(hub, b)
+    for i in range(len(bodies) - 1):
+        add_spring(bodies[i], bodies[i+1])
+        if i + spokes < len(bodies):
+            add_spring(bodies[i], bodies[i+spokes])
+
+    space.attach_points = []
+    for b in bodies[-17::4]:
+        static_body = pymunk.Body(body_type=pymunk.Body.STATIC)
+        static_body.position = b.position
+        space.attach_points.append(static_body)
+        space.add(pymunk.DampedSpring(static_body, b, (0, 0), (0, 0), 0, 20000, 100))
+    space.web = bodies
+    return space
+
+def joints(copies=1, box_size=200):
+    """
+    Every pymunk constraint type, one per box, from constraints.py
+    copies: (int) times the grid of ten demo boxes is repeated side by side
+    box_size: (float) side length of each demo box
+    """
+    space = pymunk.Space()
+    space.gravity = 0.0, -900.0
+    space.tick = 1/60
+    static = space.static_body
+
+    def body(pos, radius=None, length=None):
+        b = pymunk.Body()
+        b.position = pos
+        if radius:
+            shape = pymunk.Circle(b, radius)
+        else:
+            shape = pymunk.Segment(b, (0, length), (0, -length), 6)
+        shape.mass = 1
+        shape.friction = 0.7
+        space.add(b, shape)
+        return b
+
+    def pinned_bars(ox, oy, length=40):
+        b1 = body((ox + 50, oy + 100), length=length)
+        b2 = body((ox + 150, oy + 100), length=length)
+        space.add(pymunk.PivotJoint(b1, static, (ox + 50, oy + 100)),
+                  pymunk.PivotJoint(b2, static, (ox + 150, oy + 100)))
+        return b1, b2
+
+    width = 6*box_size
+    for copy in range(copies):
+        left = copy*width
+        for i in range(7):
+            floor = pymunk.Segment(static, (left, i*box_size), (left + width, i*box_size), 1)
+            wall = pymunk.Segment(static, (left + i*box_size, 0), (left + i*box_size, 2*box_size), 1)
+            for segment in (floor, wall):
+                segment.friction = 1
+                segment.elasticity = 1
+            space.add(floor, wall)
+
+        def balls(column):
+            ox = left + column*box_size
+            return body((ox + 50, 60), radius=20), body((ox + 150, 60), radius=20)
+
+        b1, b2 = balls(0)
+        space.add(pymunk.PinJoint(b1, b2, (20, 0), (-20, 0)))
+        b1, b2 = balls(1)
+        space.add(pymunk.SlideJoint(b1, b2, (20, 0), (-20, 0), 40, 80))
+        b1, b2 = balls(2)
+        space.add(pymunk.PivotJoint(b1, b2, (left + 2*box_size + 100, 60)))
+        b1, b2 = balls(3)
+        space.add(pymunk.GrooveJoint(b1, b2, (50, 50), (50, -50), (-50, 0)))
+        b1, b2 = balls(4)
+        space.add(pymunk.DampedSpring(b1, b2, (30, 0), (-30, 0), 20, 5, 0.3))
+
+        b1, b2 = pinned_bars(left + 5*box_size, -20)
+        space.add(pymunk.DampedRotarySpring(b1, b2, 0, 3000, 60))
+        b1, b2 = pinned_bars(left, box_size, 20)
+        space.add(pymunk.RotaryLimitJoint(b1, b2, math.pi/2, math.pi/2))
+        b1, b2 = pinned_bars(left + box_size, box_size, 20)
+        space.add(pymunk.RatchetJoint(b1, b2, 0, math.pi/2))
+        b1, b2 = pinned_bars(left + 2*box_size, box_size)
+        space.add(pymunk.GearJoint(b1, b2, 0, 2))
+        b1, b2 = pinned_bars(left + 3*box_size, box_size)
+        space.add(pymunk.SimpleMotor(b1, b2, math.pi))
+    return space
+
+# name: (builder, size argument, sizes swept by stress.py)
+SCENES = {
+    "stack": (stack, "columns", (5, 10, 20, 40, 80)),
+    "cradle": (cradle, "balls", (5, 20, 80, 320)),
+    "web": (web, "rings", (5, 10, 20, 40, 80)),
+    "joints": (joints, "copies", (1, 4, 16, 64)),
+}
+
+def build(name, size=None):
+    """
+    Returns the space for scene name, with its size argument set to size
+    """
+    builder, argument, sizes = SCENES[name]
+    if size is None:
+        return builder()
+    return builder(**{argument: size})
@@ -0,0 +1,435 @@
+"""
+Asyncio server hosting many headless QWOP sessions over a local socket
+
+Each session is a vecenv.Env: one runner in its own world. Sessions live in
+worker processes; the server only parses requests and routes them. Requests
+that arrive for a worker while it is busy are sent to it together as one
+batch, so hundreds of clients cost one pipe round trip per worker per batch
+rather than one per request.
+
+python3 server.py --socket /tmp/qwop.sock     serve on a unix socket
+python3 server.py --port 5678                 serve on 127.0.0.1:5678
+python3 server.py --load-test 200             measure step latency with 200
+                                              concurrent clients
+
+Protocol. Every message is a HEADER followed by length bytes of body.
+Requests carry an op and the number of sessions they address; replies carry
+OK or ERROR in place of the op and the same count. All numbers are little
+endian. A connection is answered in the order its requests arrive.
+
+    OPEN      body: none, count new sessions, at most MAX_OPEN
+              reply: count uint32 session ids
+    STEP      body: count uint32 ids, then count uint8 replay control codes
+              (replay.Q etc, with replay.RESET to reset before the tick)
+              reply: count*OBS_SIZE float32 observations, count float32
+              rewards, count uint8 done flags
+    RESET     body: count uint32 ids
+              reply: count*OBS_SIZE float32 observations
+    SNAPSHOT  body: count uint32 ids
+              reply: count*SNAPSHOT_SIZE float64 states: the runner's bodies
+              (Character.snapshot), the episode tick and 1 if it has fallen
+    RESTORE   body: count uint32 ids, then count*SNAPSHOT_SIZE float64 states
+              reply: none
+    CLOSE     body: count uint32 ids
+              reply: none
+    ERROR replies carry a utf-8 message.
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import socket
+import struct
+import sys
+import time
+import numpy as np
+import replay
+from character import OBS_SIZE, BODY_STATE_SIZE
+from vecenv import Env
+
+HEADER = struct.Struct("<BBHI") # op or status, reserved, count, body length
+OPEN, STEP, RESET, SNAPSHOT, RESTORE, CLOSE = range(6)
+OK, ERROR = 0x80, 0x81
+SNAPSHOT_SIZE = 8*BODY_STATE_SIZE + 2 # Env.snapshot of one session
+BACKLOG = 1024 # connections that may wait to be accepted, for bursts of clients
+MAX_OPEN = 1024 # sessions one OPEN may create
+
+class Server:
+    """
+    Routes requests from any number of connections to sessions held by
+    num_workers worker processes
+    """
+
+    def __init__(self, num_workers=None, max_steps=1000):
+        """
+        max_steps: (int) ticks after which STEP reports a session as done
+        """
+        if num_workers is None:
+            num_workers = multiprocessing.cpu_count()
+        self.workers = [Worker(max_steps) for i in range(num_workers)]
+        self.sessions = {} # session id: worker
+        self.next_id = 0
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+
+    def close(self):
+        for worker in self.workers:
+            worker.close()
+
+    async def handle(self, reader, writer):
+        """
+        Serves one connection until the client closes it
+        """
+        try:
+            while True:
+                try:
+                    header = await reader.readexactly(HEADER.size)
+                except asyncio.IncompleteReadError:
+                    break
+                op, _, count, length = HEADER.unpack(header)
+                body = await reader.readexactly(length)
+                try:
+                    reply = await self.request(op, count, body)
+                    status = OK
+                except Exception as e:
+                    reply = str(e).encode("utf-8")
+                    status = ERROR
+                writer.write(HEADER.pack(status, 0, count, len(reply)) + reply)
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def request(self, op, count, body):
+        """
+        Returns the reply body for one request
+        """
+        if count == 0:
+            raise ValueError("request addresses no sessions")
+        if op == OPEN:
+            if count > MAX_OPEN:
+                raise ValueError("cannot open %d sessions at once, at most %d" % (count, MAX_OPEN))
+            ids = np.arange(self.next_id, self.next_id + count, dtype=np.uint32)
+            self.next_id += count
+            # new sessions go to the workers holding the fewest
+            for session in ids.tolist():
+                worker = min(self.workers, key=lambda w: w.sessions)
+                worker.sessions += 1
+                self.sessions[session] = worker
+            await self.route(OPEN, ids, {})
+            return ids.tobytes()
+
+        ids = np.frombuffer(body, np.uint32, count)
+        data = {}
+        if op == STEP:
+            data["codes"] = np.frombuffer(body, np.uint8, count, 4*count)
+        elif op == RESTORE:
+            data["states"] = np.frombuffer(body, np.float64, count*SNAPSHOT_SIZE, 4*count).reshape(count, SNAPSHOT_SIZE)
+        elif op not in (RESET, SNAPSHOT, CLOSE):
+            raise ValueError("unknown op %d" % op)
+        for session in ids.tolist():
+            if session not in self.sessions:
+                raise KeyError("no session %d" % session)
+
+        results = await self.route(op, ids, data)
+        if op == CLOSE:
+            for session in ids.tolist():
+                self.sessions.pop(session).sessions -= 1
+        if op == STEP:
+            obs, rewards, dones = results
+            return (obs.astype(np.float32).tobytes() + rewards.astype(np.float32).tobytes()
+                    + dones.astype(np.uint8).tobytes())
+        if op in (RESET, SNAPSHOT):
+            return results.astype(np.float32 if op == RESET else np.float64).tobytes()
+        return b""
+
+    async def route(self, op, ids, data):
+        """
+        Splits a request by worker, runs the parts concurrently and returns
+        the results back in the order of ids
+        """
+        owners = [self.sessions[session] for session in ids.tolist()]
+        if all(worker is owners[0] for worker in owners):
+            # the usual case: a client's sessions all live on one worker
+            return await owners[0].submit((op, ids, data))
+        parts = {}
+        for i, worker in enumerate(owners):
+            parts.setdefault(worker, []).append(i)
+        jobs = []
+        for worker, rows in parts.items():
+            rows = np.array(rows)
+            job = (op, ids[rows], {name: value[rows] for name, value in data.items()})
+            jobs.append((rows, worker.submit(job)))
+        results = await asyncio.gather(*(future for rows, future in jobs))
+        if op in (OPEN, RESTORE, CLOSE):
+            return None
+
+        order = np.concatenate([rows for rows, future in jobs])
+        inverse = np.empty_like(order)
+        inverse[order] = np.arange(len(order))
+        if op == STEP:
+            return tuple(np.concatenate([r[k] for r in results])[inverse] for k in range(3))
+        return np.concatenate(results)[inverse]
+
+class Worker:
+    """
+    One worker process and the requests waiting for it. Requests submitted
+    while the process is busy go out together when it finishes.
+    """
+
+    def __init__(self, max_steps):
+        self.max_steps = max_steps
+        self.sessions = 0 # sessions held
+        self.pending = []
+        self.busy = []
+
+    def start(self):
+        self.conn, child = multiprocessing.Pipe()
+        self.proc = multiprocessing.Process(target=_worker, args=(child, self.max_steps), daemon=True)
+        self.proc.start()
+        child.close()
+        asyncio.get_running_loop().add_reader(self.conn.fileno(), self.receive)
+
+    def submit(self, job):
+        """
+        Queues job and returns a future for its result
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((job, future))
+        if not self.busy:
+            self.send()
+        return future
+
+    def send(self):
+        self.busy, self.pending = self.pending, []
+        self.conn.send([job for job, future in self.busy])
+
+    def receive(self):
+        try:
+            results = self.conn.recv()
+        except EOFError:
+            # the process died; fail everything waiting on it
+            asyncio.get_running_loop().remove_reader(self.conn.fileno())
+            results = [(False, "worker exited")]*len(self.busy + self.pending)
+            self.busy, self.pending = self.busy + self.pending, []
+        for (job, future), (ok, result) in zip(self.busy, results):
+            if future.cancelled():
+                continue
+            if ok:
+                future.set_result(result)
+            else:
+                future.set_exception(RuntimeError(result))
+        self.busy = []
+        if self.pending:
+            self.send()
+
+    def close(self):
+        asyncio.get_running_loop().remove_reader(self.conn.fileno())
+        if self.proc.is_alive():
+            self.conn.send(None)
+        self.proc.join()
+
+def _worker(conn, max_steps):
+    sessions = {}
+    while True:
+        jobs = conn.recv()
+        if jobs is None:
+            conn.close()
+            break
+        results = []
+        for job in jobs:
+            try:
+                results.append((True, _run_job(sessions, max_steps, *job)))
+            except Exception as e:
+                results.append((False, "%s: %s" % (type(e).__name__, e)))
+        conn.send(results)
+
+def _run_job(sessions, max_steps, op, ids, data):
+    ids = ids.tolist()
+    if op == OPEN:
+        for session in ids:
+            sessions[session] = Env(max_steps)
+    elif op == STEP:
+        obs = np.empty((len(ids), OBS_SIZE))
+        rewards = np.empty(len(ids))
+        dones = np.empty(len(ids), dtype=bool)
+        for i, (session, code) in enumerate(zip(ids, data["codes"].tolist())):
+            env = sessions[session]
+            if code & replay.RESET:
+                env.reset()
+            obs[i], rewards[i], dones[i] = env.step(replay.keys(code))
+        return obs, rewards, dones
+    elif op == RESET:
+        return np.array([sessions[session].reset() for session in ids])
+    elif op == SNAPSHOT:
+        return np.array([sessions[session].snapshot() for session in ids])
+    elif op == RESTORE:
+        for session, state in zip(ids, data["states"]):
+            sessions[session].restore(state)
+    elif op == CLOSE:
+        for session in ids:
+            del sessions[session]
+
+async def serve(path=None, port=None, num_workers=None, ready=None):
+    """
+    Runs a server on the unix socket at path, or on 127.0.0.1:port
+    ready: (asyncio.Event) set once the server accepts connections
+    """
+    server = Server(num_workers)
+    server.start()
+    try:
+        if path is not None:
+            if os.path.exists(path):
+                os.remove(path)
+            listener = await asyncio.start_unix_server(server.handle, path, backlog=BACKLOG)
+        else:
+            listener = await asyncio.start_server(server.handle, "127.0.0.1", port, backlog=BACKLOG)
+        async with listener:
+            if ready is not None:
+                ready.set()
+            await listener.serve_forever()
+    finally:
+        server.close()
+
+class Client:
+    """
+    Blocking client for one connection to a server
+    """
+
+    def __init__(self, path=None, port=None):
+        if path is not None:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(path)
+        else:
+            self.sock = socket.create_connection(("127.0.0.1", port))
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def call(self, op, count, body=b""):
+        """
+        Sends one request and returns the reply body
+        """
+        self.sock.sendall(HEADER.pack(op, 0, count, len(body)) + body)
+        status, _, count, length = HEADER.unpack(self._read(HEADER.size))
+        reply = self._read(length)
+        if status == ERROR:
+            raise RuntimeError(reply.decode("utf-8"))
+        return reply
+
+    def _read(self, size):
+        data = b""
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError("server closed the connection")
+            data += chunk
+        return data
+
+    def open(self, count=1):
+        """
+        Returns the ids of count new sessions
+        """
+        return np.frombuffer(self.call(OPEN, count), np.uint32)
+
+    def step(self, ids, codes):
+        """
+        Advances each session by one tick
+        codes: (array) one replay control code per session
+        Returns (obs, rewards, dones) like VecEnv.step
+        """
+        ids = np.asarray(ids, np.uint32)
+        n = len(ids)
+        reply = self.call(STEP, n, ids.tobytes() + np.asarray(codes, np.uint8).tobytes())
+        obs = np.frombuffer(reply, np.float32, n*OBS_SIZE).reshape(n, OBS_SIZE)
+        rewards = np.frombuffer(reply, np.float32, n, 4*n*OBS_SIZE)
+        dones = np.frombuffer(reply, np.uint8, n, 4*n*(OBS_SIZE + 1)).astype(bool)
+        return obs, rewards, dones
+
+    def reset(self, ids):
+        ids = np.asarray(ids, np.uint32)
+        return np.frombuffer(self.call(RESET, len(ids), ids.tobytes()), np.float32).reshape(len(ids), OBS_SIZE)
+
+    def snapshot(self, ids):
+        ids = np.asarray(ids, np.uint32)
+        return np.frombuffer(self.call(SNAPSHOT, len(ids), ids.tobytes())).reshape(len(ids), SNAPSHOT_SIZE)
+
+    def restore(self, ids, states):
+        ids = np.asarray(ids, np.uint32)
+        self.call(RESTORE, len(ids), ids.tobytes() + np.asarray(states, np.float64).tobytes())
+
+    def close(self, ids=None):
+        """
+        Closes the sessions in ids, then the connection if ids is None
+        """
+        if ids is not None:
+            ids = np.asarray(ids, np.uint32)
+            self.call(CLOSE, len(ids), ids.tobytes())
+            return
+        self.sock.close()
+
+async def load_test(clients=100, steps=200, sessions=1, num_workers=None):
+    """
+    Runs a server and clients concurrent connections to it, each stepping
+    its own sessions steps times. Returns step latencies in seconds.
+    """
+    path = "/tmp/qwop-%d.sock" % os.getpid() if hasattr(socket, "AF_UNIX") else None
+    port = None if path else 5678
+    ready = asyncio.Event()
+    task = asyncio.create_task(serve(path, port, num_workers, ready))
+    await ready.wait()
+
+    async def client():
+        if path:
+            reader, writer = await asyncio.open_unix_connection(path)
+        else:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+
+        async def call(op, count, body=b""):
+            writer.write(HEADER.pack(op, 0, count, len(body)) + body)
+            status, _, count, length = HEADER.unpack(await reader.readexactly(HEADER.size))
+            return await reader.readexactly(length)
+
+        ids = np.frombuffer(await call(OPEN, sessions), np.uint32)
+        latencies = []
+        for tick in range(steps):
+            codes = np.full(sessions, (tick // 20) % 2 + replay.Q, np.uint8)
+            start = time.perf_counter()
+            await call(STEP, sessions, ids.tobytes() + codes.tobytes())
+            latencies.append(time.perf_counter() - start)
+        await call(CLOSE, sessions, ids.tobytes())
+        writer.close()
+        return latencies
+
+    results = await asyncio.gather(*(client() for i in range(clients)))
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    return np.concatenate(results)
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve headless QWOP sessions")
+    parser.add_argument("--socket", help="unix socket path to listen on")
+    parser.add_argument("--port", type=int, help="TCP port on 127.0.0.1 to listen on")
+    parser.add_argument("--workers", type=int, help="worker processes, one per core by default")
+    parser.add_argument("--load-test", type=int, metavar="CLIENTS", help="measure latency with this many clients")
+    parser.add_argument("--steps", type=int, default=200, help="steps per client in the load test")
+    args = parser.parse_args()
+
+    if args.load_test:
+        start = time.perf_counter()
+        latencies = asyncio.run(load_test(args.load_test, args.steps, num_workers=args.workers))
+        elapsed = time.perf_counter() - start
+        print("%d clients, %d steps: %.0f steps/s, latency p50 %.2f ms, p99 %.2f ms" % (
+            args.load_test, len(latencies), len(latencies) / elapsed,
+            np.percentile(latencies, 50)*1e3, np.percentile(latencies, 99)*1e3))
+        return 0
+    if args.socket is None and args.port is None:
+        parser.error("give --socket or --port")
+    asyncio.run(serve(args.socket, args.port, args.workers))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
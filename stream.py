@@ -0,0 +1,187 @@
+"""
+Shared-memory stream of runner transforms for out-of-process viewers
+
+python3 stream.py --runners 20     simulate 20 headless runners with random
+                                   gaits and publish them for viewer.py
+
+A StreamWriter publishes the (x, y, angle) of every body of its runners,
+the same transforms CharacterSprites draws, into a ring of frames in a
+memory-mapped file. Readers in other processes map the same file and copy
+out the latest complete frame whenever they like, without locks: the writer
+never waits for a reader, so a slow viewer cannot stall the simulation.
+
+File layout, little endian:
+    [0, 64)   header: MAGIC, then uint32 version, runners, bodies per
+              runner and slots, then at LATEST the uint64 sequence number
+              of the last complete frame (0 before the first)
+    [64, ...) slots frames of SLOT_HEADER uint64 (begin, tick, end, unused)
+              followed by runners*bodies*3 float64 transforms
+
+Frame n goes to slot n % slots. The writer stores begin = n, the
+transforms, the tick and end = n, then LATEST = n. A reader takes LATEST,
+checks that the slot's end matches, copies the frame and checks that begin
+still matches; if the writer lapped it meanwhile it tries again. This
+relies on stores becoming visible in program order, as on x86.
+"""
+
+import argparse
+import mmap
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+import replay
+import world
+from character import Transforms
+
+MAGIC = b"QWOPSTRM"
+VERSION = 1
+HEADER_SIZE = 64
+LATEST = 32 # byte offset of the latest sequence number
+SLOT_HEADER = 4 # uint64 per slot before its transforms
+SLOTS = 4 # frames kept; a reader must copy one before this many more arrive
+RETRIES = 8
+
+# Where streams go by default: shared memory when the system has it
+DEFAULT_PATH = os.path.join("/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(), "qwop.stream")
+
+def frame_size(runners, bodies):
+    return 8*(SLOT_HEADER + runners*bodies*3)
+
+class Stream:
+    """
+    A mapped stream file, shared by StreamWriter and StreamReader
+    """
+
+    def __init__(self, mapping):
+        self.mapping = mapping
+        version, self.runners, self.bodies, self.slots = np.frombuffer(mapping, np.uint32, 4, len(MAGIC))
+        if mapping[:len(MAGIC)] != MAGIC or version != VERSION:
+            raise ValueError("not a version %d QWOP stream" % VERSION)
+        self.latest = np.frombuffer(mapping, np.uint64, 1, LATEST)
+        count = self.slots*frame_size(self.runners, self.bodies)//8
+        slots = np.frombuffer(mapping, np.uint64, count, HEADER_SIZE).reshape(self.slots, -1)
+        self.heads = slots[:, :SLOT_HEADER]
+        self.frames = slots[:, SLOT_HEADER:].view(np.float64).reshape(self.slots, self.runners, self.bodies, 3)
+
+    def close(self):
+        # the numpy views must go before the mapping can be closed
+        self.latest = self.heads = self.frames = None
+        self.mapping.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class StreamWriter(Stream):
+
+    def __init__(self, path=DEFAULT_PATH, runners=1, bodies=8, slots=SLOTS):
+        """
+        Creates the stream file at path, replacing any earlier one. Readers
+        still attached to a replaced file stop seeing new frames and have
+        to attach again.
+        runners: (int) runners in every frame
+        bodies: (int) bodies per runner, len(Character.bodies)
+        """
+        size = HEADER_SIZE + slots*frame_size(runners, bodies)
+        header = bytearray(HEADER_SIZE)
+        header[:len(MAGIC)] = MAGIC
+        header[len(MAGIC):len(MAGIC) + 16] = np.array([VERSION, runners, bodies, slots], np.uint32).tobytes()
+        # built beside path and moved into place, so a reader never maps a
+        # half-written header or a file that shrinks under it
+        partial = "%s.%d.tmp" % (path, os.getpid())
+        with open(partial, "w+b") as f:
+            f.write(header)
+            f.truncate(size)
+            mapping = mmap.mmap(f.fileno(), size)
+        os.replace(partial, path)
+        self.path = path
+        super().__init__(mapping)
+        self.seq = 0
+        self.gather = None
+
+    def publish(self, characters, tick=0):
+        """
+        Writes the current transforms of characters as the next frame
+        characters: (list) the stream's runners, in the same order each time
+        tick: (int) simulation tick of the frame, e.g. space.ticks
+        """
+        seq = self.seq + 1
+        slot = seq % self.slots
+        head = self.heads[slot]
+        head[0] = seq
+        if self.gather is None or self.gather.characters != characters:
+            self.gather = Transforms(list(characters))
+        self.gather(self.frames[slot])
+        head[1] = tick
+        head[2] = seq
+        self.latest[0] = seq
+        self.seq = seq
+
+class StreamReader(Stream):
+
+    def __init__(self, path=DEFAULT_PATH):
+        with open(path, "rb") as f:
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.path = path
+        super().__init__(mapping)
+        self.frame = np.zeros((self.runners, self.bodies, 3))
+        self.seq = 0
+        self.tick = 0
+
+    def read(self):
+        """
+        Copies the latest complete frame into self.frame and returns it,
+        shape (runners, bodies, 3). Returns the previous frame again when
+        nothing new was published or the writer kept lapping the reader.
+        """
+        for attempt in range(RETRIES):
+            seq = int(self.latest[0])
+            if seq == self.seq:
+                break
+            slot = seq % self.slots
+            head = self.heads[slot]
+            if head[2] != seq:
+                continue
+            tick = int(head[1])
+            np.copyto(self.frame, self.frames[slot])
+            if head[0] == seq:
+                self.seq = seq
+                self.tick = tick
+                break
+        return self.frame
+
+def main():
+    parser = argparse.ArgumentParser(description="Publish headless runners for viewer.py")
+    parser.add_argument("path", nargs="?", default=DEFAULT_PATH, help="stream file to write")
+    parser.add_argument("--runners", type=int, default=20, help="runners sharing one world")
+    parser.add_argument("--hold", type=int, default=8, help="ticks each gait key is held")
+    parser.add_argument("--slots", type=int, default=SLOTS, help="frames kept in the stream file")
+    parser.add_argument("--fast", action="store_true", help="step as fast as possible, not in real time")
+    args = parser.parse_args()
+
+    # runners never collide, so they share one start line and overlap
+    space, characters = world.setup_runners(args.runners, spacing=0)
+    rng = np.random.default_rng()
+    gaits = rng.integers(replay.NONE, replay.P + 1, size=(args.runners, 8))
+    writer = StreamWriter(args.path, len(characters), slots=args.slots)
+    print("publishing %d runners to %s" % (len(characters), args.path))
+    start = time.perf_counter()
+    while True:
+        key = space.ticks // args.hold % gaits.shape[1]
+        for character, code in zip(characters, gaits[:, key].tolist()):
+            if character.fallen_tick is not None and space.ticks - character.fallen_tick > 100:
+                character.reset()
+            replay.apply(character, code)
+        world.step(space)
+        writer.publish(characters, space.ticks)
+        if not args.fast:
+            ahead = start + space.ticks*world.TICK - time.perf_counter()
+            if ahead > 0:
+                time.sleep(ahead)
+
+if __name__ == "__main__":
+    sys.exit(main())
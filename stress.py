@@ -0,0 +1,114 @@
+"""
+Scaling sweep over the stress scenes in scenes.py
+
+python3 stress.py                          sweep every scene at every size
+python3 stress.py --scenes web --sizes 10 100 --iterations 5 10 40
+python3 stress.py -o stress.json           also save the results as JSON
+
+For each scene and size it reports physics steps/sec, the cost per body
+step, peak memory and, for every solver iteration count, how far the bodies
+end up from a run with the most iterations. Each measurement runs in a fresh
+process so memory numbers are not polluted by earlier scenes.
+"""
+
+import argparse
+import json
+import multiprocessing
+import platform
+import resource
+import sys
+import time
+import numpy as np
+import scenes
+
+def measure_scene(name, size, iterations=10, steps=300, warmup=20):
+    """
+    Builds and steps one scene. Returns a dict of counts, steps/sec, memory
+    in KiB (peak resident size growth from building and stepping the scene)
+    and the final body positions for comparing iteration counts.
+    """
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    space = scenes.build(name, size)
+    space.iterations = iterations
+    for i in range(warmup):
+        space.step(space.tick)
+    start = time.perf_counter()
+    for i in range(steps):
+        space.step(space.tick)
+    elapsed = time.perf_counter() - start
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        after, before = after // 1024, before // 1024 # reported in bytes
+    return {
+        "scene": name,
+        "size": size,
+        "iterations": iterations,
+        "bodies": len(space.bodies),
+        "constraints": len(space.constraints),
+        "shapes": len(space.shapes),
+        "steps_per_sec": steps / elapsed,
+        "memory_kib": after - before,
+        "positions": [tuple(body.position) for body in space.bodies],
+    }
+
+def _measure(job):
+    return measure_scene(*job)
+
+def sweep(names=None, sizes=None, iterations=(5, 10, 20), steps=300):
+    """
+    Returns one result per scene, size and iteration count, see measure_scene.
+    Each result also has "error": the largest distance of a body from where
+    it ends up with the most iterations, 0 for the run with the most.
+    names: (list) scenes to run, all of scenes.SCENES when None
+    sizes: (list) sizes to run each scene at, the scene's own sweep when None
+    """
+    names = names or list(scenes.SCENES)
+    jobs = []
+    for name in names:
+        for size in sizes or scenes.SCENES[name][2]:
+            for count in sorted(iterations, reverse=True):
+                jobs.append((name, size, count, steps))
+
+    # one task per process, so every scene starts from a clean heap
+    with multiprocessing.Pool(1, maxtasksperchild=1) as pool:
+        results = pool.map(_measure, jobs, chunksize=1)
+
+    reference = None
+    for result in results:
+        positions = np.array(result.pop("positions")).reshape(-1, 2)
+        if result["iterations"] == max(iterations):
+            reference = positions
+        result["error"] = float(np.max(np.linalg.norm(positions - reference, axis=1), initial=0))
+    return results
+
+def print_results(results):
+    print("%-8s %6s %6s %7s %7s %12s %12s %10s %10s" % ("scene", "size", "iters", "bodies",
+          "joints", "steps/s", "us/body-step", "mem KiB", "error"))
+    for r in results:
+        per_body = 1e6 / (r["steps_per_sec"] * max(r["bodies"], 1))
+        print("%-8s %6d %6d %7d %7d %12.1f %12.3f %10d %10.3g" % (r["scene"], r["size"],
+              r["iterations"], r["bodies"], r["constraints"], r["steps_per_sec"],
+              per_body, r["memory_kib"], r["error"]))
+
+def main():
+    parser = argparse.ArgumentParser(description="Physics scaling sweep over the stress scenes")
+    parser.add_argument("--scenes", nargs="+", choices=list(scenes.SCENES), help="scenes to run")
+    parser.add_argument("--sizes", nargs="+", type=int, help="sizes to run every scene at")
+    parser.add_argument("--iterations", nargs="+", type=int, default=[5, 10, 20],
+                        help="solver iteration counts to compare")
+    parser.add_argument("--steps", type=int, default=300, help="timed steps per measurement")
+    parser.add_argument("-o", "--output", help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = sweep(args.scenes, args.sizes, args.iterations, args.steps)
+    print_results(results)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"python": platform.python_version(),
+                       "machine": platform.machine(),
+                       "results": results}, f, indent=2)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
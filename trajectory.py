@@ -0,0 +1,410 @@
+"""
+Columnar trajectory files: every body state, action and contact of a run
+
+python3 trajectory.py out.traj run1.qwop run2.qwop ...   simulate recordings
+                                                          and save them
+python3 trajectory.py out.traj --random 100 --ticks 5000 random gaits
+python3 trajectory.py --info out.traj                    summarize and time
+                                                          a full scan
+
+A file holds any number of runners recorded in lockstep. Ticks are grouped
+into chunks, and inside a chunk each column is one contiguous array, so a
+reader memory-maps the file and gets any column of any chunk as a NumPy
+view without copying or parsing. Per tick and runner the columns are:
+
+    state    float32 (bodies, BODY_STATE_SIZE) after the tick, in
+             character.save_bodies layout, Character.bodies order
+    action   uint8 replay control code applied during the tick
+    contact  uint8 bit i set when CONTACT_BODIES[i] touches the floor
+
+Every keyframe_every ticks the state is also kept in full float64 as a
+keyframe, to restart a simulation from with Character.restore. pymunk does
+not restore contact caches or solver warm starts, so a restarted run
+follows the recorded one closely but not bit for bit. Chunks hold a whole
+number of keyframe intervals; only the last chunk may be shorter.
+
+File layout, little endian, every part aligned to ALIGN bytes:
+    HEADER (ticks and index offset are filled in by close(); a file that
+        was never closed is read by walking its chunk headers instead)
+    chunks: CHUNK_HEADER (first tick, ticks), then the columns in COLUMNS
+        order, then the keyframes
+    index: (offset, first tick, ticks) uint64 per chunk
+"""
+
+import argparse
+import bisect
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import time
+import numpy as np
+import optimize
+import replay
+import world
+from character import BODY_STATE_SIZE, CONTACT_BODIES, Transforms
+
+MAGIC = b"QWOPTRAJ"
+VERSION = 1
+# magic, version, world width, runners, bodies, chunk ticks, keyframe
+# interval, ticks, index offset
+HEADER = struct.Struct("<8sHHIIIIQQ")
+CHUNK_HEADER = struct.Struct("<QQ") # first tick, ticks
+ALIGN = 64
+CHUNK_TICKS = 1024
+KEYFRAME_EVERY = 256
+
+# name: (dtype, shape per tick given runners and bodies)
+COLUMNS = {
+    "state": (np.float32, lambda runners, bodies: (runners, bodies, BODY_STATE_SIZE)),
+    "action": (np.uint8, lambda runners, bodies: (runners,)),
+    "contact": (np.uint8, lambda runners, bodies: (runners,)),
+}
+CONTACT_BITS = 1 << np.arange(len(CONTACT_BODIES), dtype=np.uint8)
+
+def aligned(n):
+    return -(-n // ALIGN) * ALIGN
+
+def chunk_layout(ticks, runners, bodies, keyframe_every):
+    """
+    Returns ({column: (offset, dtype, shape)}, size) of a chunk of ticks
+    ticks, with offsets from the start of the chunk. The keyframes are
+    the column "keyframe".
+    """
+    layout = {}
+    offset = aligned(CHUNK_HEADER.size)
+    for name, (dtype, shape) in COLUMNS.items():
+        shape = (ticks,) + shape(runners, bodies)
+        layout[name] = (offset, dtype, shape)
+        offset += aligned(int(np.prod(shape))*np.dtype(dtype).itemsize)
+    shape = (-(-ticks // keyframe_every), runners, bodies*BODY_STATE_SIZE)
+    layout["keyframe"] = (offset, np.float64, shape)
+    offset += aligned(int(np.prod(shape))*8)
+    return layout, offset
+
+class TrajectoryWriter:
+    """
+    Appends one row per tick for a fixed list of runners, a chunk at a time
+    """
+
+    def __init__(self, path, runners=1, bodies=8, width=world.WIDTH,
+                 chunk_ticks=CHUNK_TICKS, keyframe_every=KEYFRAME_EVERY):
+        """
+        runners: (int) runners in every row
+        bodies: (int) bodies per runner, len(Character.bodies)
+        width: (int) world width the runners were built with, as in replay
+        chunk_ticks: (int) ticks per chunk, a multiple of keyframe_every
+        """
+        if chunk_ticks % keyframe_every:
+            raise ValueError("chunk_ticks must be a multiple of keyframe_every")
+        self.file = open(path, "wb")
+        self.runners, self.bodies, self.width = runners, bodies, width
+        self.chunk_ticks, self.keyframe_every = chunk_ticks, keyframe_every
+        self.file.write(self.header(0, 0).ljust(aligned(HEADER.size), b"\0"))
+        self.layout, size = chunk_layout(chunk_ticks, runners, bodies, keyframe_every)
+        self.columns = {name: np.zeros(shape, dtype) for name, (offset, dtype, shape) in self.layout.items()}
+        self.state = np.empty((runners, bodies, BODY_STATE_SIZE))
+        self.gather = None
+        self.ticks = 0 # written so far, including the open chunk
+        self.filled = 0 # ticks in the open chunk
+        self.index = []
+
+    def header(self, ticks, index_offset):
+        return HEADER.pack(MAGIC, VERSION, self.width, self.runners, self.bodies,
+                           self.chunk_ticks, self.keyframe_every, ticks, index_offset)
+
+    def write(self, characters, actions):
+        """
+        Appends the tick that was just simulated
+        characters: (list) the runners, in the same order every tick
+        actions: (array) replay control code each runner was given
+        """
+        if self.gather is None or self.gather.characters != characters:
+            self.gather = Transforms(list(characters), velocities=True)
+        state = self.gather(self.state)
+        i = self.filled
+        self.columns["state"][i] = state
+        self.columns["action"][i] = actions
+        contacts = np.stack([character.contacts[:, 0] for character in characters])
+        self.columns["contact"][i] = (contacts > 0) @ CONTACT_BITS
+        if self.ticks % self.keyframe_every == 0:
+            self.columns["keyframe"][i // self.keyframe_every] = state.reshape(self.runners, -1)
+        self.ticks += 1
+        self.filled += 1
+        if self.filled == self.chunk_ticks:
+            self._flush()
+
+    def _flush(self):
+        """
+        Writes out the open chunk, if it holds any ticks. Only full chunks
+        and, at close, the last one are written, so that keyframes stay at
+        multiples of keyframe_every.
+        """
+        n = self.filled
+        if n == 0:
+            return
+        layout, size = chunk_layout(n, self.runners, self.bodies, self.keyframe_every)
+        start = self.file.tell()
+        self.file.write(CHUNK_HEADER.pack(self.ticks - n, n))
+        for name, (offset, dtype, shape) in layout.items():
+            self.file.seek(start + offset)
+            self.file.write(self.columns[name][:shape[0]].tobytes())
+        self.file.seek(start + size)
+        self.file.truncate()
+        self.index.append((start, self.ticks - n, n))
+        self.filled = 0
+
+    def close(self):
+        self._flush()
+        index_offset = self.file.tell()
+        self.file.write(np.array(self.index, np.uint64).reshape(-1, 3).tobytes())
+        self.file.seek(0)
+        self.file.write(self.header(self.ticks, index_offset))
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class TrajectoryReader:
+    """
+    Memory-maps a trajectory file. Columns come back as read-only views of
+    the mapping, so reading a range costs nothing until it is touched.
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, self.width, self.runners, self.bodies, self.chunk_ticks,
+         self.keyframe_every, ticks, index_offset) = HEADER.unpack_from(self.mapping)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("%s is not a version %d QWOP trajectory" % (path, VERSION))
+        if index_offset:
+            count = (len(self.mapping) - index_offset) // 24
+            self.index = np.frombuffer(self.mapping, np.uint64, count*3, index_offset).reshape(-1, 3).tolist()
+        else:
+            self.index = self.walk()
+        self.ticks = sum(n for offset, first, n in self.index)
+        self.firsts = [first for offset, first, n in self.index]
+
+    def walk(self):
+        """
+        Returns the index of a file that was not closed, from its chunk
+        headers, leaving out a last chunk that was cut short
+        """
+        index = []
+        offset = aligned(HEADER.size)
+        while offset + CHUNK_HEADER.size <= len(self.mapping):
+            first, n = CHUNK_HEADER.unpack_from(self.mapping, offset)
+            layout, size = chunk_layout(n, self.runners, self.bodies, self.keyframe_every)
+            if n == 0 or offset + size > len(self.mapping):
+                break
+            index.append((offset, first, n))
+            offset += size
+        return index
+
+    def locate(self, tick):
+        """
+        Returns the index of the chunk holding tick
+        """
+        if not 0 <= tick < self.ticks:
+            raise IndexError("tick %d is outside the %d ticks of the file" % (tick, self.ticks))
+        return bisect.bisect_right(self.firsts, tick) - 1
+
+    def chunk(self, i):
+        """
+        Returns {column: view} for chunk i, keyframes included
+        """
+        start, first, n = self.index[i]
+        layout, size = chunk_layout(n, self.runners, self.bodies, self.keyframe_every)
+        return {name: np.frombuffer(self.mapping, dtype, int(np.prod(shape)), start + offset).reshape(shape)
+                for name, (offset, dtype, shape) in layout.items()}
+
+    def views(self, name, start=0, stop=None):
+        """
+        Yields zero-copy views of column name covering ticks [start, stop),
+        one per chunk touched, for scanning long ranges
+        """
+        stop = self.ticks if stop is None else min(stop, self.ticks)
+        tick = start
+        while tick < stop:
+            i = self.locate(tick)
+            first = self.index[i][1]
+            column = self.chunk(i)[name]
+            end = min(stop, first + len(column))
+            yield column[tick - first:end - first]
+            tick = end
+
+    def column(self, name, start=0, stop=None):
+        """
+        Returns column name for ticks [start, stop): a view when the range
+        lies within one chunk, otherwise a copy
+        """
+        views = list(self.views(name, start, stop))
+        if len(views) == 1:
+            return views[0]
+        if views:
+            return np.concatenate(views)
+        dtype, shape = COLUMNS[name]
+        return np.zeros((0,) + shape(self.runners, self.bodies), dtype)
+
+    def keyframe(self, tick):
+        """
+        Returns (keyframe tick, states) for the last keyframe at or before
+        tick; states has one row per runner for Character.restore
+        """
+        i = self.locate(tick)
+        first = self.index[i][1]
+        k = (tick - first) // self.keyframe_every
+        return first + k*self.keyframe_every, self.chunk(i)["keyframe"][k]
+
+    def close(self):
+        try:
+            self.mapping.close()
+        except BufferError:
+            pass # views are still in use; the mapping goes when they do
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class Playback:
+    """
+    Poses of every runner in a set of trajectory files at any tick, for
+    drawing recorded runs as ghosts next to a live one
+    """
+
+    def __init__(self, paths, width=world.WIDTH):
+        """
+        paths: (list) trajectory files, whose every runner is played, or
+               replay.py recordings, which are simulated into a temporary
+               trajectory file per world width first
+        width: (int) world width of the live runner; runs recorded in a
+               world of another width are shifted to its start line
+        """
+        self.temporary = []
+        recordings = {}
+        for path in paths:
+            if path.endswith(".qwop"):
+                recorded_width, controls = replay.load(path)
+                recordings.setdefault(recorded_width, []).append(controls)
+        for recorded_width, controls in recordings.items():
+            fd, path = tempfile.mkstemp(suffix=".traj")
+            os.close(fd)
+            record(path, controls, recorded_width)
+            self.temporary.append(path)
+        paths = [path for path in paths if not path.endswith(".qwop")] + self.temporary
+        self.readers = [TrajectoryReader(path) for path in paths]
+        self.shifts = [width//2 - reader.width//2 for reader in self.readers]
+        self.count = sum(reader.runners for reader in self.readers)
+        self.bodies = self.readers[0].bodies
+        self.out = np.empty((self.count, self.bodies, 3))
+
+    def transforms(self, tick, alpha=1.0):
+        """
+        Returns the (x, y, angle) of every body after tick ticks of each
+        run, shape (count, bodies, 3), interpolated from the tick before by
+        alpha as CharacterSprites does. Runs that ended hold their last pose.
+        """
+        i = 0
+        for reader, shift in zip(self.readers, self.shifts):
+            t = min(max(tick, 1), reader.ticks)
+            rows = reader.column("state", max(t - 2, 0), t)[..., :3]
+            current, previous = rows[-1], rows[0]
+            if tick > reader.ticks or len(rows) == 1:
+                previous = current
+            out = self.out[i:i + reader.runners]
+            np.subtract(current, previous, out=out)
+            out *= alpha
+            out += previous
+            out[..., 0] += shift
+            i += reader.runners
+        return self.out
+
+    def close(self):
+        for reader in self.readers:
+            reader.close()
+        self.readers = []
+        self.out = None
+        for path in self.temporary:
+            os.remove(path)
+        self.temporary = []
+
+def record(path, controls, width=world.WIDTH):
+    """
+    Simulates runs side by side, each in its own world as replay.run does,
+    and writes their trajectories to path. Runs that end early idle.
+    controls: (list) per-tick control codes of each run
+    """
+    worlds = [world.setup_world(width) for c in controls]
+    characters = [character for space, character in worlds]
+    ticks = max(len(c) for c in controls)
+    codes = np.zeros((ticks, len(controls)), np.uint8)
+    for i, c in enumerate(controls):
+        codes[:len(c), i] = c
+    with TrajectoryWriter(path, len(characters), width=width) as writer:
+        for row in codes:
+            for (space, character), code in zip(worlds, row.tolist()):
+                replay.apply(character, code)
+                world.step(space)
+            writer.write(characters, row)
+    return [world.distance(character) for character in characters]
+
+def info(path):
+    with TrajectoryReader(path) as reader:
+        size = os.path.getsize(path)
+        print("%s: %d runners, %d ticks, %d chunks, %.1f MiB, %.1f bytes per runner tick"
+              % (path, reader.runners, reader.ticks, len(reader.index), size/2**20,
+                 size/max(reader.runners*reader.ticks, 1)))
+        # record writes runners built from the default morphology
+        space, template = world.setup_world(reader.width)
+        torso = template.bodies.index(template.torso)
+        start = time.perf_counter()
+        best = np.full(reader.runners, -np.inf, np.float32)
+        for view in reader.views("state"):
+            np.maximum(best, view[:, :, torso, 0].max(axis=0), out=best)
+        elapsed = time.perf_counter() - start
+        print("full scan of torso x: %.1f ms, farthest torso x %.1f" % (elapsed*1e3, best.max()))
+
+def main():
+    parser = argparse.ArgumentParser(description="Write or summarize trajectory files")
+    parser.add_argument("path", help="trajectory file")
+    parser.add_argument("recordings", nargs="*", help="replay.py recordings to simulate")
+    parser.add_argument("--random", type=int, default=0, help="also simulate this many random gaits")
+    parser.add_argument("--ticks", type=int, default=2000, help="ticks of each random gait")
+    parser.add_argument("--info", action="store_true", help="summarize an existing file")
+    args = parser.parse_args()
+
+    if args.info:
+        info(args.path)
+        return 0
+    # a file holds runs at one world width
+    widths = {}
+    controls = []
+    for recording in args.recordings:
+        w, c = replay.load(recording)
+        widths.setdefault(w, []).append(recording)
+        controls.append(c)
+    if len(widths) > 1:
+        parser.error("recordings of different widths go in separate files: %s"
+                     % "; ".join("%d: %s" % (w, " ".join(paths)) for w, paths in widths.items()))
+    width = next(iter(widths), world.WIDTH)
+    rng = np.random.default_rng()
+    for i in range(args.random):
+        genome = rng.integers(replay.NONE, replay.P + 1, size=8)
+        controls.append(optimize.expand(genome, 10, args.ticks))
+    if not controls:
+        parser.error("nothing to record")
+    start = time.perf_counter()
+    distances = record(args.path, controls, width)
+    print("recorded %d runs in %.1f s, best %.2f meters" % (len(controls), time.perf_counter() - start, max(distances)))
+    info(args.path)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
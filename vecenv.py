@@ -0,0 +1,188 @@
+"""
+Vectorized QWOP environments stepped across a pool of worker processes
+
+Each environment is an independent world built by world.setup_world().
+Environments are split into contiguous chunks, one chunk per worker, so a
+call to VecEnv.step costs one message round trip per worker, not per world.
+"""
+
+import multiprocessing
+import numpy as np
+import stream
+import world
+from character import OBS_SIZE
+
+class Env:
+    """
+    One headless runner. Actions are 4 values for the Q, W, O and P keys;
+    nonzero means pressed. The reward is the distance gained in meters.
+    Observations use the Character.observation layout and are written into
+    observation (allocated if None), which is overwritten on every call.
+    """
+
+    def __init__(self, max_steps=1000, observation=None):
+        self.max_steps = max_steps
+        self.space = world.setup_space()
+        self.character = world.add_runner(self.space, observation=observation)
+        self.reset()
+
+    def reset(self):
+        self.character.reset()
+        self.tick = 0
+        self.distance = world.distance(self.character)
+        return self.character.observe()
+
+    def step(self, action):
+        world.apply_controls(self.character, *action)
+        world.step(self.space)
+        self.tick += 1
+
+        distance = world.distance(self.character)
+        reward = distance - self.distance
+        self.distance = distance
+        done = self.tick >= self.max_steps or world.fallen(self.character)
+        return self.character.observe(), reward, done
+
+    def snapshot(self):
+        """
+        Returns the runner's Character.snapshot followed by the episode tick
+        and 1 if the runner has fallen, else 0
+        """
+        return np.concatenate([self.character.snapshot(), [self.tick, world.fallen(self.character)]])
+
+    def restore(self, state):
+        """
+        Puts back the episode state returned by snapshot
+        """
+        fallen = self.space.ticks if state[-1] else None
+        self.character.restore(state[:-2], fallen)
+        self.tick = int(state[-2])
+        self.distance = world.distance(self.character)
+        return self.character.observe()
+
+class VecEnv:
+    """
+    num_envs independent runners spread over num_workers processes.
+    With num_workers=0 everything runs in the calling process.
+    Environments that finish are reset automatically; the observation
+    returned for them is the first one of the new episode.
+    With num_workers=0 the returned observations are the environments' own
+    buffer and are overwritten by the next call.
+    """
+
+    def __init__(self, num_envs, num_workers=None, max_steps=1000, stream=None):
+        """
+        stream: (str) when given, worker i publishes the body transforms of
+                its environments after every call to "<stream>.<i>" for
+                viewer.py, see stream.py; the only worker with num_workers=0
+        """
+        if num_workers is None:
+            num_workers = multiprocessing.cpu_count()
+        self.num_envs = num_envs
+        self.num_workers = min(num_workers, num_envs)
+
+        self.local = None
+        self.conns = []
+        self.procs = []
+        if self.num_workers == 0:
+            self.local = _make_chunk(num_envs, max_steps, _stream_path(stream, 0))
+            return
+
+        chunk = np.array_split(np.arange(num_envs), self.num_workers)
+        self.bounds = [0] + list(np.cumsum([len(c) for c in chunk]))
+        for i, c in enumerate(chunk):
+            parent, child = multiprocessing.Pipe()
+            proc = multiprocessing.Process(target=_worker, args=(child, len(c), max_steps, _stream_path(stream, i)),
+                                           daemon=True)
+            proc.start()
+            child.close()
+            self.conns.append(parent)
+            self.procs.append(proc)
+
+    def reset(self):
+        """
+        Resets every environment and returns observations, shape (N, OBS_SIZE)
+        """
+        if self.local is not None:
+            return _reset_chunk(self.local)
+        for conn in self.conns:
+            conn.send(("reset", None))
+        return np.concatenate([conn.recv() for conn in self.conns])
+
+    def step(self, actions):
+        """
+        actions: (N, 4) array for the Q, W, O and P keys
+        Returns (obs, rewards, dones) with shapes (N, OBS_SIZE), (N,), (N,)
+        """
+        actions = np.asarray(actions)
+        if self.local is not None:
+            return _step_chunk(self.local, actions)
+
+        for i, conn in enumerate(self.conns):
+            conn.send(("step", actions[self.bounds[i]:self.bounds[i+1]]))
+        results = [conn.recv() for conn in self.conns]
+        obs = np.concatenate([r[0] for r in results])
+        rewards = np.concatenate([r[1] for r in results])
+        dones = np.concatenate([r[2] for r in results])
+        return obs, rewards, dones
+
+    def close(self):
+        for conn in self.conns:
+            conn.send(("close", None))
+        for proc in self.procs:
+            proc.join()
+        self.conns = []
+        self.procs = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def _stream_path(prefix, worker):
+    return None if prefix is None else "%s.%d" % (prefix, worker)
+
+def _make_chunk(count, max_steps, stream_path=None):
+    """
+    Returns count environments whose observations are the rows of one array
+    stream_path: (str) file to publish the environments' transforms to
+    """
+    obs = np.zeros((count, OBS_SIZE))
+    envs = [Env(max_steps, obs[i]) for i in range(count)]
+    if stream_path:
+        envs[0].writer = stream.StreamWriter(stream_path, count)
+    return envs
+
+def _publish(envs):
+    writer = getattr(envs[0], "writer", None)
+    if writer:
+        writer.publish([env.character for env in envs], envs[0].tick)
+
+def _reset_chunk(envs):
+    for env in envs:
+        env.reset()
+    _publish(envs)
+    return envs[0].character.observation.base
+
+def _step_chunk(envs, actions):
+    rewards = np.empty(len(envs))
+    dones = np.empty(len(envs), dtype=bool)
+    for i, env in enumerate(envs):
+        obs, rewards[i], dones[i] = env.step(actions[i])
+        if dones[i]:
+            env.reset()
+    _publish(envs)
+    return envs[0].character.observation.base, rewards, dones
+
+def _worker(conn, count, max_steps, stream_path=None):
+    envs = _make_chunk(count, max_steps, stream_path)
+    while True:
+        cmd, data = conn.recv()
+        if cmd == "step":
+            conn.send(_step_chunk(envs, data))
+        elif cmd == "reset":
+            conn.send(_reset_chunk(envs))
+        elif cmd == "close":
+            conn.close()
+            break
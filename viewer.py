@@ -0,0 +1,129 @@
+"""
+Watches runners published by stream.py from another process
+
+python3 viewer.py                              watch the default stream
+python3 viewer.py /dev/shm/qwop.stream.*       watch several streams at once
+
+The viewer only reads shared memory, at its own frame rate; the simulations
+it watches never wait for it. The view follows the runner in the lead.
+Streams that do not exist yet, or that are replaced because their writer
+restarted, are attached again once a second.
+"""
+
+import os
+import sys
+import pyglet
+from pyglet import shapes
+from pyglet.math import Mat4
+from render import PoseSprites, sprite_layout
+import scenery
+import stream
+import world
+
+window = pyglet.window.Window()
+background_batch = pyglet.graphics.Batch()
+track_batch = pyglet.graphics.Batch()
+runner_batch = pyglet.graphics.Batch()
+label = pyglet.text.Label('', font_name='Times New Roman', font_size=24,
+                          x=window.width//2, y=window.height*0.9,
+                          anchor_x='center', anchor_y='center')
+status = pyglet.text.Label('', font_name='Courier New', font_size=10,
+                           x=10, y=window.height-10, anchor_x='left', anchor_y='top')
+fps_display = pyglet.window.FPSDisplay(window=window)
+background = []
+
+# A headless runner to read the sprite layout and start line from
+template = world.add_runner(world.setup_space())
+layout = sprite_layout(template)
+TORSO = template.bodies.index(template.torso)
+START = template.torso.start_position.x
+
+# path: [StreamReader, inode, PoseSprites per runner]
+streams = {path: [None, None, []] for path in sys.argv[1:] or [stream.DEFAULT_PATH]}
+
+def attach(dt=0):
+    """
+    Maps every stream that is new or was replaced since it was last mapped
+    """
+    for path, entry in streams.items():
+        reader, inode, sprites = entry
+        try:
+            current = os.stat(path).st_ino
+        except FileNotFoundError:
+            continue
+        if current == inode:
+            continue
+        try:
+            new = stream.StreamReader(path)
+        except (ValueError, OSError):
+            continue # still being created
+        if new.bodies != len(layout):
+            new.close()
+            continue
+        for pose in sprites:
+            pose.delete()
+        if reader:
+            reader.close()
+        entry[:] = [new, current, [PoseSprites(layout, runner_batch) for i in range(new.runners)]]
+
+def build_background():
+    global background
+    w, h = window.width, window.height
+    objs = []
+    for h1, h2, c1, c2 in scenery.bands(h):
+        colors = c1 + c1 + c2 + c2
+        objs.append(shapes.Polygon((0, h*h1), (w, h*h1), (w, h*h2), (0, h*h2),
+                                   color=colors, batch=background_batch))
+    for quad, colors in scenery.start_marker(START, h):
+        color = tuple(c for rgba in colors for c in rgba)
+        objs.append(shapes.Polygon(*quad, color=color, batch=track_batch))
+    background = objs
+
+@window.event
+def on_resize(width, height):
+    build_background()
+
+@window.event
+def on_draw():
+    window.clear()
+    w, h = window.width, window.height
+
+    lead = None
+    count = 0
+    ticks = []
+    for reader, inode, sprites in streams.values():
+        if reader is None:
+            continue
+        frame = reader.read()
+        count += reader.runners
+        if not reader.seq:
+            continue # nothing published yet
+        for pose, transforms in zip(sprites, frame):
+            pose.update(transforms)
+        x = frame[:, TORSO, 0].max()
+        lead = x if lead is None else max(lead, x)
+        ticks.append(reader.tick)
+    lc = (START if lead is None else lead) - w//2
+
+    pyglet.gl.glEnable(pyglet.gl.GL_BLEND)
+    pyglet.gl.glBlendFunc(pyglet.gl.GL_SRC_ALPHA, pyglet.gl.GL_ONE_MINUS_SRC_ALPHA)
+    window.projection = Mat4.orthogonal_projection(0, w, 0, h, -1, 1)
+    background_batch.draw()
+    window.projection = Mat4.orthogonal_projection(lc, lc+w, 0, h, -1, 1)
+    track_batch.draw()
+    runner_batch.draw()
+
+    window.projection = Mat4.orthogonal_projection(0, w, 0, h, -1, 1)
+    if lead is None:
+        label.text = "waiting for %s" % ", ".join(streams)
+    else:
+        label.text = "%.1f meters" % ((lead - START)*world.DISTANCE_FACTOR)
+    label.draw()
+    status.text = "%d streams, %d runners, tick %s" % (len(ticks), count, max(ticks) if ticks else "-")
+    status.draw()
+    fps_display.draw()
+
+attach()
+build_background()
+pyglet.clock.schedule_interval(attach, 1.0)
+pyglet.app.run(1/60)
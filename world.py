@@ -0,0 +1,396 @@
+"""
+Headless QWOP world: floor, runner, controls and stepping
+
+Imports no pyglet, so episodes can be simulated without a display.
+qwop.py is the windowed front end on top of this module.
+"""
+
+import math
+import numpy as np
+import pymunk
+import pymunk.batch
+from pymunk.vec2d import Vec2d
+from character import Character, Observer, save_bodies, load_bodies, BODY_STATE_SIZE, OBS_SIZE, CONTACT_BODIES
+
+# Matches the default pyglet window so headless runs score like the game
+WIDTH = 640
+HEIGHT = 480
+FLOOR_HEIGHT = 10
+DISTANCE_FACTOR = 1.25/200
+RUNNER_SPACING = 2000
+TICK = 1/50/2 # simulated seconds advanced by one call to step
+SUBSTEPS = 10 # space.step calls per tick unless the space steps adaptively
+# Spatial hash cell size, and the (runners, spacing) at or above and below
+# which the "auto" broadphase uses it. From python3 bench.py --world: the
+# bounding box tree wins while runners are spread out, the hash once many
+# of them crowd the same stretch of track.
+HASH_CELL = 400
+HASH_WHEN = [(16, 150), (128, 1000), (256, math.inf)]
+
+def setup_world(width=WIDTH, profiler=None, impulses=False, substeps=SUBSTEPS, morphology=None):
+    """
+    Returns (space, character) for a new world with one runner at its start
+    width: (int) width of the view the runner is centered in
+    profiler: (Profiler) times the collision callbacks when given
+    impulses: (bool) accumulate contact impulses, see setup_space
+    substeps: (int or AdaptiveSubsteps) see setup_space
+    morphology: (dict) the runner's body plan, see morphology.py
+    """
+    space = setup_space(width, profiler=profiler, impulses=impulses, substeps=substeps)
+    character = add_runner(space, width, morphology=morphology)
+    return space, character
+
+def setup_runners(count, width=WIDTH, spacing=RUNNER_SPACING, observations=None, contacts=None, impulses=False,
+                  sleep=None, broadphase="tree", tile=None, substeps=SUBSTEPS, morphology=None):
+    """
+    Returns (space, characters) for one world with count runners that share
+    the floor and a single space.step but never collide with each other.
+    spacing: (float) distance between start lines. Runners that overlap
+             still cost the broadphase a pair check for every two shapes,
+             so keeping them apart keeps the step cost linear in count.
+    observations: (array) shape (count, OBS_SIZE); row i becomes runner i's
+             observation buffer so observe() writes straight into the batch.
+             Allocated if None.
+    contacts: (array) shape (count, len(CONTACT_BODIES), 2), bound the same
+             way to each runner's contacts. Allocated if None.
+    impulses: (bool) accumulate contact impulses, see setup_space
+    sleep, tile, substeps: see setup_space
+    broadphase: (str) "tree", "hash" or "auto", see set_broadphase.
+             large_world returns the options that suit big populations.
+    morphology: (dict) body plan shared by every runner, see morphology.py
+    """
+    if observations is None:
+        observations = np.zeros((count, OBS_SIZE))
+    if contacts is None:
+        contacts = np.zeros((count, len(CONTACT_BODIES), 2))
+    space = setup_space(width, count*spacing, impulses=impulses, sleep=sleep, tile=tile, substeps=substeps)
+    characters = [add_runner(space, width, i+1, i*spacing, observations[i], contacts[i], morphology) for i in range(count)]
+    set_broadphase(space, broadphase, spacing)
+    return space, characters
+
+def large_world():
+    """
+    Returns the world-builder options for setup_runners that did best for
+    populations of runners in python3 bench.py --world: runners that stop
+    moving sleep, the floor is tiled and the broadphase follows HASH_WHEN
+    """
+    return {"sleep": 0.5, "broadphase": "auto", "tile": RUNNER_SPACING}
+
+def setup_space(width=WIDTH, extra=0, profiler=None, impulses=False, sleep=None, tile=None, substeps=SUBSTEPS):
+    """
+    Returns a new space containing only the floor
+    extra: (float) floor length added past the usual end, for extra start lines
+    profiler: (Profiler) times the collision callbacks when given
+    impulses: (bool) accumulate the floor's normal impulse on each sensed
+              body into Character.contacts. This runs a callback for every
+              contact on every substep and makes stepping several times
+              slower, so it is off unless asked for. Contact counts are
+              always kept, as they only change when contacts begin or end.
+    sleep: (float) seconds a runner must stay still before its bodies are
+              put to sleep and skipped by the solver and broadphase until a
+              control touches them. Fallen runners soon come to rest, so in
+              a big shared world most of them end up asleep. None keeps every
+              body awake, which replays and the game rely on.
+    tile: (float) length of each static floor segment. One segment spanning
+              the whole track covers every cell of a spatial hash it
+              crosses; short tiles only fill the cells near them. None lays
+              a single segment.
+    substeps: (int or AdaptiveSubsteps) space.step calls per tick. A fixed
+              count steps the same way on every run, which replays and the
+              prefix cache rely on; an AdaptiveSubsteps picks the count each
+              tick from how violent the last one was.
+    """
+    space = pymunk.Space()
+    space.ticks = 0 # calls to step so far
+    space.substeps = substeps
+    space.substeps_taken = 0 # space.step calls so far
+    space.contact_events = 0 # floor contacts begun or ended so far
+    space.runners = []
+    space.impulses = impulses
+    space.gravity = 0,-9820
+    space.damping = 0.99
+    if sleep is not None:
+        space.sleep_time_threshold = sleep
+
+    handler = space.add_collision_handler(100, 1)
+    handler.begin = hit_ground if profiler is None else profiler.wrap("hit_ground", hit_ground)
+    handler.separate = contact_separate
+    if impulses:
+        handler.post_solve = contact_post_solve
+
+    handler = space.add_collision_handler(100, 2)
+    handler.begin = contact_begin
+    handler.separate = contact_separate
+    if impulses:
+        handler.post_solve = contact_post_solve
+
+    floorHeight = FLOOR_HEIGHT
+    left, right = -width*100, width*100+extra
+    if tile is None:
+        floor = pymunk.Segment(space.static_body, Vec2d(left,floorHeight), Vec2d(right,10), 1)
+        floor.friction = 10.3
+        floor.collision_type = 100
+        space.add(floor)
+    else:
+        add_tiles(space, left, right, floorHeight, tile)
+    return space
+
+def set_broadphase(space, broadphase, spacing=RUNNER_SPACING):
+    """
+    Picks the collision broadphase of space once its shapes are added
+    broadphase: (str) "tree" keeps pymunk's default bounding box tree, "hash"
+              switches to a spatial hash with HASH_CELL sized cells, "auto"
+              switches when the runners and their spacing match HASH_WHEN
+    spacing: (float) distance between start lines
+    """
+    if broadphase == "auto":
+        crowded = any(len(space.runners) >= runners and spacing < apart for runners, apart in HASH_WHEN)
+        broadphase = "hash" if crowded else "tree"
+    if broadphase == "hash":
+        # Chipmunk suggests about 10 hash cells per shape
+        space.use_spatial_hash(HASH_CELL, 10*len(space.shapes))
+
+def add_tiles(space, left, right, height, tile):
+    """
+    Lays the floor from left to right as static segments of length tile. Each
+    segment knows its neighbours so bodies slide across seams without
+    catching on them.
+    """
+    count = max(1, int(math.ceil((right - left) / tile)))
+    xs = np.linspace(left, right, count + 1)
+    for i in range(count):
+        floor = pymunk.Segment(space.static_body, Vec2d(xs[i], height), Vec2d(xs[i+1], height), 1)
+        floor.set_neighbors(Vec2d(xs[max(i-1, 0)], height), Vec2d(xs[min(i+2, count)], height))
+        floor.friction = 10.3
+        floor.collision_type = 100
+        space.add(floor)
+
+def add_runner(space, width=WIDTH, group=1, startx=0, observation=None, contacts=None, morphology=None):
+    """
+    Adds a runner at the start line of space and returns it
+    group: (int) filter group, distinct for each runner sharing space
+    startx: (float) how far right of the usual start line to place the runner
+    observation: (array) buffer for the runner's observations, see Character
+    contacts: (array) buffer for the runner's contact state, see Character
+    morphology: (dict) the runner's body plan, morphology.DEFAULT if None
+    """
+    w = 100
+    h = 200
+    bodyx = width // 2 + startx
+    bodyy = FLOOR_HEIGHT + h + h/8 + 10 
+    character = Character(space, bodyx, bodyy, w, h, group, observation, contacts, morphology)
+    space.runners.append(character)
+    return character
+
+def step(space, profiler=None):
+    """
+    Advances space by one fixed TICK
+    profiler: (Profiler) times each substep when given
+    """
+    space.ticks += 1
+    if space.impulses:
+        for character in space.runners:
+            character.contacts[:, 1] = 0
+    substeps = space.substeps
+    if callable(substeps):
+        substeps = substeps(space)
+    space.substeps_taken += substeps
+    if profiler is None:
+        for x in range(substeps):
+            space.step(TICK/substeps)
+        return
+    for x in range(substeps):
+        with profiler.phase("substep"):
+            space.step(TICK/substeps)
+
+class AdaptiveSubsteps:
+    """
+    Chooses how many substeps each tick gets from the state the last tick
+    left behind: how far the runners' RotaryLimitJoints are past their
+    limits, the fastest body and how many floor contacts began or ended.
+    Calm ticks, such as runners standing or lying still, get few substeps;
+    impacts get many so the joint limits hold. In a shared space the most
+    violent runner sets the count for all of them.
+
+    Measuring costs about as much as three substeps of one runner, so the
+    count is measured every `every` ticks and kept in between. A tick in
+    which floor contacts begin or end, which only costs reading a counter,
+    measures again at once.
+
+    The choice only depends on the simulation, so a run from a fresh world
+    repeats exactly, but the result differs from the fixed SUBSTEPS that
+    recordings were made with. One instance belongs to one space.
+    """
+
+    fields = pymunk.batch.BodyFields.BODY_ID | pymunk.batch.BodyFields.ANGLE | pymunk.batch.BodyFields.VELOCITY
+
+    def __init__(self, min_substeps=4, max_substeps=16, limit_error=(0.05, 0.2), speed=2500, impacts=8, every=8):
+        """
+        min_substeps, max_substeps: (int) bounds on substeps per tick
+        limit_error: (tuple) joint limit error in radians up to which a tick
+                     counts as calm, and at which it gets max_substeps. A
+                     runner lying on the floor rests about 0.03 past its limits.
+        speed: (float) body velocity, along x or y, that gets max_substeps
+        impacts: (int) floor contacts beginning or ending in one tick that
+                 get max_substeps
+        every: (int) ticks between measurements without contact events
+        """
+        self.min_substeps = min_substeps
+        self.max_substeps = max_substeps
+        self.limit_error = limit_error
+        self.speed = speed
+        self.impacts = impacts
+        self.every = every
+        self.buffer = pymunk.batch.Buffer()
+        self.ids = None
+        self.events = 0
+        self.wait = 0 # ticks until the next measurement
+        self.substeps = min_substeps
+
+    def index(self, space, ids):
+        """
+        Maps the joint limits of every runner to rows of the body export
+        ids: (bytes) body ids in export order
+        """
+        row = {body_id: i for i, body_id in enumerate(np.frombuffer(ids, dtype=np.uintp))}
+        limits = [joint.limit for character in space.runners for joint in character.joints]
+        self.a = np.array([row[limit.a.id] for limit in limits], dtype=np.intp)
+        self.b = np.array([row[limit.b.id] for limit in limits], dtype=np.intp)
+        # error is how far the relative angle is from the middle of the
+        # allowed range, less half its width
+        self.center = np.array([(limit.min + limit.max)/2 for limit in limits])
+        self.half = np.array([(limit.max - limit.min)/2 for limit in limits])
+        self.ids = ids
+
+    def __call__(self, space):
+        if not space.runners:
+            return self.min_substeps
+        impacts = space.contact_events - self.events
+        self.events = space.contact_events
+        if self.wait and not impacts:
+            self.wait -= 1
+            return self.substeps
+        self.wait = self.every - 1
+        buffer = self.buffer
+        buffer.clear()
+        pymunk.batch.get_space_bodies(space, self.fields, buffer)
+        # bodies change order when runners are added, retired or fall asleep
+        ids = buffer.int_buf()[:]
+        if ids != self.ids:
+            self.index(space, ids)
+        state = np.frombuffer(buffer.float_buf()).reshape(-1, 3)
+
+        angle = state[:, 0]
+        error = (np.abs(angle[self.b] - angle[self.a] - self.center) - self.half).max()
+        velocity = state[:, 1:]
+        speed = max(velocity.max(), -velocity.min())
+
+        low, high = self.limit_error
+        demand = max((error - low) / (high - low), speed / self.speed, impacts / self.impacts)
+        demand = min(max(demand, 0), 1)
+        self.substeps = self.min_substeps + int(math.ceil(demand * (self.max_substeps - self.min_substeps)))
+        return self.substeps
+
+# The Observer of the runners world.observe was last called with
+_observer = None
+
+def observe(characters):
+    """
+    Refills the observation buffer of every runner in characters from one
+    bulk export of their spaces and returns the observations, shape
+    (len(characters), OBS_SIZE). Pass the same list each time so the
+    export's index is reused.
+    """
+    global _observer
+    if _observer is None or _observer.characters != characters:
+        _observer = Observer(list(characters))
+    return _observer()
+
+def snapshot(space, out=None):
+    """
+    Returns the state of every dynamic body in space as a flat array,
+    followed by space.ticks. Restoring it into the same space, or into a
+    new one built the same way, puts every runner back in O(bodies).
+    """
+    if out is None:
+        out = np.empty(len(space.bodies)*BODY_STATE_SIZE + 1)
+    save_bodies(space.bodies, out)
+    out[-1] = space.ticks
+    return out
+
+def restore(space, state):
+    """
+    Inverse of snapshot. Runners count as standing again, as after
+    Character.reset, so restore states taken before any runner fell.
+    """
+    load_bodies(space.bodies, state[:-1])
+    space.ticks = int(state[-1])
+    for character in space.runners:
+        character.fallen_tick = None
+        character.contacts[:, 1] = 0
+
+def apply_controls(character, q, w, o, p):
+    """
+    Applies the impulse for the active QWOP key. Only one key acts per update,
+    with Q taking priority over W, W over O and O over P.
+    """
+    if q:
+        character.move_thighL()
+    elif w:
+        character.move_thighR()
+    elif o:
+        character.move_calfL()
+    elif p:
+        character.move_calfR()
+
+def distance(character):
+    """
+    Returns the distance in meters shown by the game for character
+    """
+    lc = character.get_position()[0] - character.torso.start_position[0]
+    return lc * DISTANCE_FACTOR
+
+def fallen(character):
+    """
+    Returns True once the runner's head or torso has touched the floor
+    """
+    return character.fallen_tick is not None
+
+def retire(space, character):
+    """
+    Removes a runner from space, so runners that are done, such as fallen
+    ones, no longer cost anything in a shared space
+    """
+    for body in character.bodies:
+        space.remove(body, *body.shapes)
+    for joint in character.joints:
+        space.remove(joint, joint.limit)
+    space.runners.remove(character)
+
+def hit_ground(arbiter, space, data):
+    """
+    Collision begin between the floor and a head or torso: marks the runner
+    as fallen on the current tick
+    """
+    character = arbiter.shapes[1].body.character
+    if character.fallen_tick is None:
+        character.fallen_tick = space.ticks
+    return contact_begin(arbiter, space, data)
+
+def contact_begin(arbiter, space, data):
+    space.contact_events += 1
+    body = arbiter.shapes[1].body
+    if body.contact_index >= 0:
+        body.character.contacts[body.contact_index, 0] += 1
+    return True
+
+def contact_separate(arbiter, space, data):
+    space.contact_events += 1
+    body = arbiter.shapes[1].body
+    if body.contact_index >= 0:
+        body.character.contacts[body.contact_index, 0] -= 1
+
+def contact_post_solve(arbiter, space, data):
+    body = arbiter.shapes[1].body
+    if body.contact_index >= 0:
+        body.character.contacts[body.contact_index, 1] += abs(arbiter.total_impulse.dot(arbiter.normal))